@@ -0,0 +1,230 @@
+# Matcher benchmark
+#
+# Runs do_match on fixed slices of the bundled data (Matcher2012 vs. Matcher2013) and on synthetic databases, and
+# records the speed (schools per second), the peak memory and a checksum of the results in a JSON file, so that two
+# commits can be compared:
+#
+#   python benchmark.py --sizes 1000 5000 --output before.json
+#   python benchmark.py --sizes 1000 5000 --output after.json
+#   python benchmark.py --compare before.json after.json
+#
+# Each case runs in its own process, so that the peak memory of one case does not hide the one of the next.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from matcher_saber import do_match
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data")
+
+# Tokens used to build the synthetic school names.
+PREFIXES = ["COLEGIO", "ESCUELA", "INST EDUC", "CENT EDUC", "SEDE", "ESC RUR MIX", "COL DPTAL", "LICEO",
+            "CONCENTRACION"]
+WORDS = ["SAN", "SANTA", "JOSE", "MARIA", "ANTONIO", "NARIÑO", "SIMON", "BOLIVAR", "LA", "EL", "DE", "LOS", "ESPERANZA",
+         "PORVENIR", "FRANCISCO", "PAULA", "SANTANDER", "POLICARPA", "SALAVARRIETA", "GABRIEL", "GARCIA", "MARQUEZ",
+         "JORGE", "ELIECER", "GAITAN", "CAMILO", "TORRES", "PIO", "XII", "NUEVO", "HORIZONTE", "VILLA", "NUEVA",
+         "RAFAEL", "POMBO", "MIGUEL", "CARO", "DIVINO", "NIÑO", "SAGRADO", "CORAZON", "INMACULADA", "CONCEPCION"]
+STATUSES = ["Complete", "MunNaN", "DaneNaN", "FulNaN"]
+
+
+def synthetic_schools(n, duplication=0.3, nan_shares=None, av_meet=True, seed=0):
+    """ Generates an original and a comparison database with known properties.
+
+    The comparison schools are random names (a prefix and two to four words) with a municipality, a DANE code, an
+    ID and a meeting time. Each original school is one of them, with its name either kept as it is (with
+    probability duplication) or changed (one word dropped, replaced or misspelled).
+
+    Arguments
+    -------------
+    n: Number of schools in each database.
+    duplication: Share of the original names that are exactly the same as their comparison name.
+    nan_shares: A dictionary {status: share} with the share of original schools in each information status
+                (Complete, MunNaN, DaneNaN, FulNaN). By default, 70% are complete and 10% are in each other status.
+    av_meet: If True, the databases include the meeting time.
+    seed: Seed of the random generator.
+
+    Returns
+    ------------
+        Two NumPy 2D-arrays of objects (original, comparison), like pd.read_csv(...).values.
+
+    """
+    rng = np.random.default_rng(seed)
+    if nan_shares is None:
+        nan_shares = {"Complete": 0.7, "MunNaN": 0.1, "DaneNaN": 0.1, "FulNaN": 0.1}
+    shares = np.array([nan_shares.get(status, 0) for status in STATUSES], dtype=float)
+
+    municipalities = rng.integers(5001, 99999, size=max(n // 50, 1)).astype(float)
+    columns = 5 if av_meet else 4
+    comparison = np.empty((n, columns), dtype=object)
+    for i in range(n):
+        words = rng.choice(WORDS, size=rng.integers(2, 5))
+        comparison[i, 0] = " ".join([rng.choice(PREFIXES)] + list(words))
+        comparison[i, 1] = municipalities[rng.integers(len(municipalities))]
+        comparison[i, 2] = float(comparison[i, 1] * 10 ** 7 + rng.integers(10 ** 6))
+        comparison[i, 3] = 100000 + i
+        if av_meet:
+            comparison[i, 4] = rng.choice(["M", "T", "C"])
+
+    original = comparison[rng.permutation(n)].copy()
+    for i in range(n):
+        if rng.random() >= duplication:
+            original[i, 0] = perturb(original[i, 0], rng)
+        original[i, 3] = 500000 + i
+        status = STATUSES[rng.choice(len(STATUSES), p=shares / shares.sum())]
+        if status in ("MunNaN", "FulNaN"):
+            original[i, 1] = np.nan
+        if status in ("DaneNaN", "FulNaN"):
+            original[i, 2] = np.nan
+    return original, comparison
+
+
+def perturb(name, rng):
+    """ Drops, replaces or misspells one word of name. """
+    words = name.split()
+    k = rng.integers(len(words))
+    change = rng.integers(3)
+    if change == 0 and len(words) > 2:
+        del words[k]
+    elif change == 1:
+        words[k] = rng.choice(WORDS)
+    else:
+        j = rng.integers(len(words[k]))
+        words[k] = words[k][:j] + words[k][j + 1:] if len(words[k]) > 1 else words[k]
+    return " ".join(words)
+
+
+def peak_rss():
+    """ Peak resident memory of the current process in MB (None if it can't be measured). """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def run_case(case):
+    """ Runs one case (a dictionary, see cases) and returns it with its measures. """
+    if case["source"] == "synthetic":
+        original, comparison = synthetic_schools(case["size"], case["duplication"], case["nan_shares"],
+                                                 case["av_meet"], case["seed"])
+    else:
+        # Every version of do_match accepts the arrays of pd.read_csv, so two commits can always be compared.
+        columns = 5 if case["av_meet"] else 4
+        original = pd.read_csv(os.path.join(DATA, "Matcher2012.csv")).values[:case["size"], :columns]
+        comparison = pd.read_csv(os.path.join(DATA, "Matcher2013.csv")).values[:case["size"], :columns]
+
+    with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        results = do_match(original, comparison, doc=os.path.join(folder, "benchmark.xlsx"), partial=False,
+                           av_meet=case["av_meet"], **case["options"])
+        seconds = time.perf_counter() - start
+
+    return dict(case, schools=len(original), comparisons=len(comparison), seconds=seconds,
+                schools_per_sec=len(original) / seconds, peak_rss_mb=peak_rss(),
+                checksum=checksum(results))
+
+
+def checksum(results):
+    """ SHA-256 of the results of do_match, written in the same way for every version: the numbers as floats, and
+    without the row of zeros that the first versions put at the top. """
+    rows = np.asarray(results, dtype=object)
+    if len(rows) > 0 and all(not isinstance(value, str) and value == 0 for value in rows[0]):
+        rows = rows[1:]
+    rows = [[repr(float(value)) if isinstance(value, (int, float, np.number)) else str(value) for value in row]
+            for row in rows]
+    return hashlib.sha256(pd.DataFrame(rows).to_csv().encode("utf-8")).hexdigest()
+
+
+def cases(sizes, synthetic_size, duplications, options):
+    """ Lists the cases of a run: each size of the bundled data, with and without meeting time, and the synthetic
+    databases with each duplication rate and with each status as the one of most original schools. """
+    listed = []
+    for size in sizes:
+        for av_meet in (False, True):
+            listed.append({"name": "saber-{}-{}".format(size or "full", "meet" if av_meet else "no-meet"),
+                           "source": "bundled", "size": size, "av_meet": av_meet, "options": options})
+    for duplication in duplications:
+        for status in STATUSES:
+            nan_shares = dict.fromkeys(STATUSES, 0.1)
+            nan_shares[status] = 0.7
+            listed.append({"name": "synthetic-{}-dup{}-{}".format(synthetic_size, duplication, status),
+                           "source": "synthetic", "size": synthetic_size, "duplication": duplication,
+                           "nan_shares": nan_shares, "av_meet": True, "seed": 0, "options": options})
+    return listed
+
+
+def commit():
+    """ The current git commit, if any. """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(DATA),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    """ Prints the speedup of each case between two benchmark files, and whether the results changed. """
+    with open(before) as file:
+        old = {case["name"]: case for case in json.load(file)["cases"]}
+    with open(after) as file:
+        new = {case["name"]: case for case in json.load(file)["cases"]}
+
+    for name in new:
+        if name in old:
+            print("{:40} {:10.1f} -> {:10.1f} schools/sec  x{:5.2f}  {}".format(
+                name, old[name]["schools_per_sec"], new[name]["schools_per_sec"],
+                new[name]["schools_per_sec"] / old[name]["schools_per_sec"],
+                "same results" if old[name]["checksum"] == new[name]["checksum"] else "RESULTS CHANGED"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of do_match.")
+    parser.add_argument("--sizes", nargs="*", default=["1000", "5000", "20000", "full"],
+                        help="Sizes of the slices of the bundled data ('full' for the whole files).")
+    parser.add_argument("--synthetic-size", type=int, default=2000, help="Size of the synthetic databases.")
+    parser.add_argument("--duplications", nargs="*", type=float, default=[0.1, 0.5],
+                        help="Exact duplication rates of the synthetic names.")
+    parser.add_argument("--workers", type=int, default=1, help="The workers option of do_match.")
+    parser.add_argument("--output", default=None, help="JSON file with the results (benchmark-<commit>.json).")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two benchmark files.")
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        compare(*arguments.compare)
+        return
+
+    sizes = [None if size == "full" else int(size) for size in arguments.sizes]
+    run = {"commit": commit(), "python": platform.python_version(), "platform": platform.platform(),
+           "date": time.strftime("%Y-%m-%d %H:%M:%S"), "cases": []}
+
+    # The first versions of do_match don't have the workers option.
+    options = {} if arguments.workers == 1 else {"workers": arguments.workers}
+    for case in cases(sizes, arguments.synthetic_size, arguments.duplications, options):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_case, case).result()
+        run["cases"].append(result)
+        print("{:40} {:8} schools {:10.1f} schools/sec {:8.1f} MB  {}".format(
+            result["name"], result["schools"], result["schools_per_sec"], result["peak_rss_mb"] or 0,
+            result["checksum"][:12]))
+
+    output = arguments.output or "benchmark-{}.json".format(run["commit"] or "run")
+    with open(output, "w") as file:
+        json.dump(run, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import pandas as pd
+from matcher_saber import replace_lines, id_crosswalk
 
 directory = r"C:\Users\JuanEduardo\Google Drive\Gloria\Matcher\Resultados"
 
@@ -6,25 +7,20 @@ do_file = open("id_replace.do", "w")
 do_file.write("\n /* Si un colegio hizo match con los de 2012, se le pondrá el código de 2012.  ")
 do_file.write("\n Si el código ID de un año es igual al de 2012, entonces se deja igual. ")
 do_file.write("\n si no lo es, entonces se asegura de que haya una compatibilidad superior al 95%. */")
+crosswalk = []
 for y in range(2013, 2017):
     print(y)
-    doc = ""
     data = pd.read_csv(directory+"\Matcher-2012-vs"+str(y)+".csv")
-    data = pd.DataFrame(data)
     year = str(y)
-    txt1 = "replace id_sede = "
-    txt2 = " if id_sede == "
-    txt3 = " & periodo == " + year
     # Lo que necesito es que... si el ID no está vacío...
 
-    for id in range(len(data)):
-        matchid = data.ix[id, "Match ID"]
-        comp = data.ix[id, "Similarity"]
-        oid = data.ix[id, "Original ID"]
-        if matchid != 0 and comp > 95 and matchid != 248814:
-            if matchid != oid:
-                line = txt1 + str(oid) + txt2 + str(matchid) + txt3
-                do_file.write("\n"+line)
+    for block in replace_lines(data, condition=" & periodo == " + year, threshold=95, exclude=[248814],
+                               changed_only=True):
+        do_file.write("\n"+block)
+    crosswalk.append(id_crosswalk(data, threshold=95, exclude=[248814], changed_only=True, period=y))
 
 do_file.close()
 
+# The same replacements, as a table that can be merged in Stata (merge m:1 periodo id_sede).
+pd.concat(crosswalk).to_csv("id_crosswalk.csv", index=False)
+
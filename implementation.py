@@ -16,12 +16,10 @@ from matcher_saber import *
 
 directory = r"C:\Users\JuanEduardo\Google Drive\Gloria\Matcher\BasesPython"
 
-saber11 = pd.read_csv(directory+"\Matcher11.csv")                 # The Saber 11° Database
-saber11 = saber11.values
+saber11 = load_schools(directory+"\Matcher11.csv", av_meet=False)              # The Saber 11° Database
 
-saber3 = pd.read_csv(directory+"\Base359_matcher.csv")                 # Saber 3°, 5°, 9° Database
-saber3 = saber3.values
-saber3 = saber3[:1000, :]
+saber3 = load_schools(directory+"\Base359_matcher.csv", av_meet=False)         # Saber 3°, 5°, 9° Database
+saber3 = saber3[:1000]
 matching = do_match(saber11, saber3, doc="Matcher_3_4_2018.xlsx", freq=10)  # This implements the matcher between Saber11 and Saber359
 codes = stata_codes(matching, doc="Stata_Matcher_3_4_2018.xlsx")
 
@@ -10,10 +10,27 @@
 # Numpy, Pandas, FuzzyWuzzy, python-Levenshtein and xlsxwriter.
 
 
+import bisect
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
+from fuzzywuzzy import utils
 
 # We defined an object called School as follows:
 
@@ -24,10 +41,15 @@ class school:
         by using the available geographical and institutional information combined with one string distance measure:
         the Levenshtein distance of transformations, as provided fue the FuzzyWuzzy Library.
 
+        The matching itself is done by a school_matcher, which do_match (and match_batch) create only once for all the
+        schools. This class keeps the same interface for one school at a time.
+
         Parameters:
         ---------------------
         original: Contains all the information of the school.
         av_meet: if True, it means that meeting_time is provided (default = False).
+        metrics: A match_metrics that records the time of each stage of the matcher (default = None, nothing is
+                 recorded).
 
         Attributes:
         ---------------------
@@ -41,8 +63,10 @@ class school:
             jornada: meeting time.
 
     """
-    def __init__(self, original, av_meet=False):
+    def __init__(self, original, av_meet=False, metrics=None):
         self.av_meet = av_meet
+        self.metrics = metrics
+        self.size = (1, 5) if av_meet else (1, 4)
         if not self.av_meet:
             self.information = original.reshape(1, 4)
             self.name_original, self.mun_original, self.dane_schoriginal, self.id_original = original
@@ -54,9 +78,7 @@ class school:
         """ Finds the best match.
 
             Finds the best school that matches(if available) the Original School Name and information using the
-            set of Comparisons (aka, the other schools' names).
-
-            This is the main function of the algorithm, and it uses all the functions described below it
+            set of Comparisons (aka, the other schools' names). See school_matcher.match.
 
             Parameters
             ---------------------
@@ -64,6 +86,7 @@ class school:
                          comparison.
                          Each row of the array is thought as a school. And has the same column-order as the original:
                          [Name, Municipality, School's DANE code, School's ID].
+                         It can also be a comparison_index built from that array (do_match builds it only once).
 
             Returns
             ---------------------
@@ -75,56 +98,313 @@ class school:
                 http://chairnerd.seatgeek.com/fuzzywuzzy-fuzzy-string-matching-in-python/
 
         """
-        av_choice, na_choice = self.filter(comparisons)
+        core = self.core(comparisons)
+        unique, similarity, first = core.match(self.information[0])
+        self.status = core.status
+        self.first = np.array(first).reshape(1, 1)
+        return np.hstack([self.information, unique, np.array(similarity).reshape(1, 1), self.first])
+
+    def core(self, comparisons=None):
+        """ Returns a school_matcher for comparisons with this school loaded. """
+        if comparisons is not None and not isinstance(comparisons, comparison_index):
+            comparisons = array_index(comparisons)
+        core = school_matcher(comparisons, self.av_meet, self.metrics)
+        core.load(self.information[0])
+        return core
+
+    def solution_picker(self, solution):
+        """ Filters out non-credible solutions (see school_matcher.solution_picker). """
+        core = self.core()
+        core.status = self.status
+        return core.solution_picker(solution)
 
-        if (av_choice.shape[0] != 0) & (na_choice.shape[0] != 0):
-            av_ans = process.extractOne(self.name_original, av_choice[:, 0], scorer=fuzz.token_set_ratio)
-            na_ans = process.extractOne(self.name_original, na_choice[:, 0], scorer=fuzz.token_set_ratio)
+    def multiple(self, solmulti):
+        """ Selects one solution (see school_matcher.multiple), and sets the first attribute. """
+        core = self.core()
+        solution = core.multiple(solmulti)
+        self.first = np.array(core.first).reshape(1, 1)
+        return solution
 
-        elif (av_choice.shape[0] == 0) & (na_choice.shape != 0):
-            av_ans = (0, 0)
-            na_ans = process.extractOne(self.name_original, na_choice[:, 0], scorer=fuzz.token_set_ratio)
+    def filter(self, comparisons):
+        """ Defines an information status and divides the observations (see school_matcher.filter_rows).
 
-        elif (av_choice.shape[0] != 0) & (na_choice.shape == 0):
-            av_ans = process.extractOne(self.name_original, av_choice[:, 0], scorer=fuzz.token_set_ratio)
-            na_ans = (0, 0)
-        else:
-            av_ans = (0, 0)
-            na_ans = (0, 0)
+            Returns
+            -------------
+            with_codes: a NumPy 2D-array that contains the schools that have the same information (either DANE or
+                             municipality) as the original school.
+
+            with_na: a NumPy 2D-array that contains the schools that do not have the same information as the
+                          original school.
+
+        """
+        if not isinstance(comparisons, comparison_index):
+            comparisons = array_index(comparisons)
+
+        with_codes, with_na = self.filter_rows(comparisons)
+        return comparisons.take(with_codes), comparisons.take(with_na)
+
+    def filter_rows(self, comparisons):
+        """ Same as filter, but it returns the row numbers of both groups in the comparison_index (see
+            school_matcher.filter_rows). """
+        core = self.core(comparisons)
+        rows = core.filter_rows()
+        self.status = core.status
+        return rows
 
-        fit_av = np.array(av_ans[1]).reshape(1, 1)
-        fit_na = np.array(na_ans[1]).reshape(1, 1)
 
-        self.size = (1, 4)
+# The comparison_index of the last comparison database given to the school class as an array (see array_index).
+_array_index = {"array": None, "index": None}
+
+
+def array_index(comparisons):
+    """ Returns the comparison_index of a comparison database (a NumPy 2D-array or a school_table), building it only
+        if it's not the one of the previous call.
+
+        The school class matches one school at a time, usually against the same array, which used to be filtered
+        with masks. The index is kept (with a weak reference to the array) so that only the first school builds
+        it. The array must not be modified afterwards, or the index must be built again with comparison_index.
+    """
+    array = _array_index["array"]
+    if array is None or array() is not comparisons:
+        _array_index["index"] = comparison_index(comparisons)
+        _array_index["array"] = weakref.ref(comparisons)
+    return _array_index["index"]
+
+
+class school_matcher:
+    """ The matcher of the school class, reused for every school of a run.
+
+        do_match used to create a school object per row, with several small arrays to build the row of its answer.
+        A school_matcher is created once per comparison database instead: each school is loaded in it (which only
+        sets its attributes), and its answer is returned as the chosen comparison school, the similarity and the
+        first indicator, which match_results writes directly in its columns.
+
+        Parameters:
+        ---------------------
+        comparisons: A comparison_index (or prepared_comparison) of the comparison database.
+        av_meet: if True, it means that meeting_time is provided (default = False).
+        metrics: A match_metrics that records the time of each stage of the matcher (default = None, nothing is
+                 recorded).
+        candidates: A candidate_table where the best candidates of both searches of each school are kept (default =
+                    None). See match_candidates.
+
+        Attributes:
+        ---------------------
+            name_original, mun_original, dane_schoriginal, id_original, jornada: The information of the school that
+                                                                               is loaded (see school).
+            status: Its information status (see filter_rows).
+            first: 1 if multiple took the first of several credible solutions, 0 otherwise.
+
+    """
+    __slots__ = ("comparisons", "av_meet", "metrics", "candidates", "size", "name_original", "mun_original",
+                 "dane_schoriginal", "id_original", "jornada", "status", "first")
+
+    def __init__(self, comparisons, av_meet=False, metrics=None, candidates=None):
+        self.comparisons = comparisons
+        self.av_meet = av_meet
+        self.metrics = metrics
+        self.candidates = candidates
+        self.size = (1, 5) if av_meet else (1, 4)
+        self.jornada = np.nan
+        self.status = None
+        self.first = 0
+
+    def load(self, original):
+        """ Loads a school: a row with [Name, Municipality, School's DANE code, School's ID, (Jornada)]. """
         if self.av_meet:
-            self.size = (1, 5)
+            self.name_original, self.mun_original, self.dane_schoriginal, self.id_original, self.jornada = original
+        else:
+            self.name_original, self.mun_original, self.dane_schoriginal, self.id_original = original
+
+    def match(self, original):
+        """ Finds the best match of a school among the comparisons.
+
+            The comparison schools are divided by filter_rows, and the closest name is searched among the ones that
+            share the school's information (av_choice) and among the rest (na_choice). Then, choose picks one of
+            both answers.
+
+            If comparisons is a prepared_comparison (with exact_names = True) and some of the schools that share
+            the original school's information have exactly the same name (once processed), those schools are
+            taken as the solutions without any fuzzy search, and the similarity is 100. If solution_picker
+            discards all of them, the usual search is done. This changes the answer of choose in two cases: when
+            several schools of the same information have the exact name, choose would have preferred a single
+            school found by the na_choice search, whatever its score (the exact name wins now); and when an earlier
+            name of the same information also scores 100 (a subset of the tokens), choose would have taken that
+            one. On 286 schools of 2012 against 2013 without meeting time, 14 Match IDs change (13 of them in the
+            first case, with na_choice scores down to 76), and 8 matches accepted by the > 95 rule change. With
+            meeting time, 18 of 1143 change (3 in the first case).
+
+            If comparisons is a prepared_comparison with an accept_score, the na_choice search is skipped when
+            the av_choice search reaches that score, and otherwise it only looks for names that score at least as
+            much as the av_choice one (the others could not win the comparison of scores). This changes the
+            answer whenever the na_choice search would have found a single school that choose takes: one with a
+            higher score (even 100, when the search is skipped), or one with a lower score when the av_choice
+            search finds several schools with the best name. When the na_choice search is skipped or finds nothing
+            and the av_choice search finds a single school, the Similarity is the score of that search (when both
+            searches find a single school, it's computed again against the chosen school's row), so the accepted
+            matches change too.
+
+            Parameters
+            ---------------------
+            original: The school (see load).
+
+            Returns
+            ---------------------
+                A tuple (match, similarity, first): the chosen comparison school as a NumPy 2D-array with one row
+                (zeros if every solution was discarded), the Set Ratio of the names and the first indicator.
+
+        """
+        self.load(original)
+        av_rows, na_rows = self.measure("filter", self.filter_rows)
+        if self.metrics is not None:
+            self.metrics.count_candidates(self.status, len(av_rows), len(na_rows))
+        if self.candidates is not None:
+            return self.match_candidates(av_rows, na_rows)
+
+        # Si el nombre (procesado) aparece tal cual entre los colegios con la misma información, no hace falta buscar.
+        exact = self.exact_match(av_rows)
+        if exact is not None:
+            return exact
+
+        av_ans = self.measure("extractOne_av", self.extract, av_rows)
+        cutoff = self.na_cutoff(av_ans[1])
+        if cutoff is None:
+            na_ans = 0, 0
+        else:
+            na_ans = self.measure("extractOne_na", self.extract, na_rows, cutoff)
+            if cutoff > 0:
+                self.count_search("pruned" if na_ans[1] == 0 and len(na_rows) > 0 else "cutoff")
+
+        return self.choose(av_rows, na_rows, av_ans, na_ans)
+
+    def match_candidates(self, av_rows, na_rows):
+        """ The same as match, but both searches keep their best candidates.
+
+            The schools whose processed name is exactly the original school's name (among av_rows, if exact_names),
+            and the best candidates.k names of each search, from the best down, are added to the candidate_table. Each
+            name comes with its solutions, as in choose: the schools of the search with the same name as the first
+            school with that processed name. The searches are always complete, and the answer is the one of match.
+        """
+        comparisons = self.comparisons
+        if not isinstance(comparisons, prepared_comparison):
+            raise ValueError("The candidates can only be kept with a prepared_comparison.")
+
+        if comparisons.exact_names:
+            self.candidates.add(self, "exact", 0, comparisons.exact_rows(self.name_original, av_rows), 100)
+        answers = []
+        for search, rows in [("av", av_rows), ("na", na_rows)]:
+            if len(rows) == 0:
+                answers.append((0, 0))
+                continue
+            best = self.measure("extractOne_" + search, comparisons.top, prepare_query(self.name_original),
+                                comparisons.block(rows), self.candidates.k)
+            for rank, (score, first) in enumerate(best, 1):
+                self.candidates.add(self, search, rank, comparisons.same_name(rows, comparisons.names[first]), score)
+            answers.append((comparisons.names[best[0][1]], best[0][0]))
+
+        exact = self.exact_match(av_rows)
+        if exact is not None:
+            return exact
+        av_ans, na_ans = answers
+        cutoff = self.na_cutoff(av_ans[1])
+        if cutoff is None or na_ans[1] < cutoff:
+            na_ans = 0, 0
+        if cutoff:
+            self.count_search("pruned" if na_ans[1] == 0 and len(na_rows) > 0 else "cutoff")
+        return self.choose(av_rows, na_rows, av_ans, na_ans)
+
+    def exact_match(self, av_rows):
+        """ Returns the answer of match if some of the schools in av_rows have exactly the same name (once processed)
+            as the original school and solution_picker keeps any of them, or None otherwise (see match). """
+        comparisons = self.comparisons
+        if not isinstance(comparisons, prepared_comparison) or not comparisons.exact_names:
+            return None
+        exact = self.measure("exact_names", comparisons.exact_rows, self.name_original, av_rows)
+        if len(exact) > 0:
+            solution = self.measure("solution_picker", self.solution_picker, comparisons.take(exact))
+            if solution.dtype == object:  # solution_picker returns zeros when it discards every solution.
+                unique = self.measure("multiple", self.multiple, solution).reshape(self.size)
+                return unique, 100, self.first
+        return None
+
+    def na_cutoff(self, av_score):
+        """ Returns the score_cutoff of the na_choice search given the score of the av_choice one: 0 if comparisons
+            has no accept_score, and None if the search is skipped (see match). """
+        comparisons = self.comparisons
+        if not isinstance(comparisons, prepared_comparison) or comparisons.accept_score is None:
+            return 0
+        if av_score >= comparisons.accept_score:
+            self.count_search("skipped")
+            return None
+        return av_score
+
+    def choose(self, av_rows, na_rows, av_ans, na_ans):
+        """ Chooses between the answers (name, score) of the av_choice and na_choice searches, and returns the
+            answer of match. """
+        comparisons = self.comparisons
+
+        # Añado que si una solución es única, tome ese elemento.
+        solution_av = comparisons.take(comparisons.same_name(av_rows, av_ans[0]))
+        solution_na = comparisons.take(comparisons.same_name(na_rows, na_ans[0]))
 
-        # Añado que si una solución es única, tome ese elemento. 
-        solution_av = av_choice[av_choice[:, 0] == av_ans[0]]
-        solution_na = na_choice[na_choice[:, 0] == na_ans[0]]
-        
         n_av = len(solution_av)
         n_na = len(solution_na)
-        
+
         if n_av == 1 and n_na != 1:
-            unique = self.multiple(self.solution_picker(solution_av)).reshape(self.size)  # Luego arreglo.
-            return np.hstack([self.information, unique, fit_av, self.first])
-        
+            solution = self.measure("solution_picker", self.solution_picker, solution_av)  # Luego arreglo.
+            unique = self.measure("multiple", self.multiple, solution).reshape(self.size)
+            return unique, av_ans[1], self.first
+
         elif n_na == 1 and n_av != 1:
-            unique = self.multiple(self.solution_picker(solution_na)).reshape(self.size)  # Luego arreglo.
-            return np.hstack([self.information, unique, fit_na, self.first])
-        
+            solution = self.measure("solution_picker", self.solution_picker, solution_na)  # Luego arreglo.
+            unique = self.measure("multiple", self.multiple, solution).reshape(self.size)
+            return unique, na_ans[1], self.first
+
         else:
-           
-            if fit_av >= fit_na:
-    
-                unique = self.multiple(self.solution_picker(solution_av)).reshape(self.size)
-                fit_av = np.array(fuzz.token_set_ratio(self.name_original, unique)).reshape(1, 1)
-                return np.hstack([self.information, unique, fit_av, self.first])
+            if av_ans[1] >= na_ans[1]:
+                solution = self.measure("solution_picker", self.solution_picker, solution_av)
             else:
-                unique = self.multiple(self.solution_picker(solution_na)).reshape(self.size)
-                fit_na = np.array(fuzz.token_set_ratio(self.name_original, unique)).reshape(1, 1)
-                return np.hstack([self.information, unique, fit_na, self.first])
+                solution = self.measure("solution_picker", self.solution_picker, solution_na)
+            unique = self.measure("multiple", self.multiple, solution).reshape(self.size)
+            return unique, fuzz.token_set_ratio(self.name_original, unique), self.first
+
+    def measure(self, stage, function, *args):
+        """ Calls function(*args), recording its time under stage if the matcher has a match_metrics. """
+        if self.metrics is None:
+            return function(*args)
+        return self.metrics.measure(stage, function, *args)
+
+    def count_search(self, outcome):
+        """ Counts how a na_choice search ended when there is an accept_score (see match_metrics). """
+        if self.metrics is not None:
+            self.metrics.searches[outcome] = self.metrics.searches.get(outcome, 0) + 1
+
+    def extract(self, rows, score_cutoff=0):
+        """ Finds the comparison school (among rows) whose name is the closest to the original school's name.
+
+            If comparisons is a prepared_comparison, its pre-processed names are used. Otherwise, the names are
+            scored with FuzzyWuzzy's extractOne. Both give the same answer.
+
+            Parameters
+            --------------
+            rows: The row numbers of the comparison schools that are considered.
+            score_cutoff: Only names that score at least this much are considered (default = 0).
+
+            Returns
+            --------------
+                A tuple (name, score) with the closest name and its Set Ratio, or (0, 0) if rows is empty or no
+                name reaches score_cutoff.
+        """
+        comparisons = self.comparisons
+        if len(rows) == 0:
+            return 0, 0
+        if isinstance(comparisons, prepared_comparison):
+            if score_cutoff > 0:
+                return comparisons.extract_one(self.name_original, rows, floor=max(comparisons.floor, score_cutoff))
+            return comparisons.extract_one(self.name_original, rows)
+        answer = process.extractOne(self.name_original, comparisons.names[rows], scorer=fuzz.token_set_ratio,
+                                    score_cutoff=score_cutoff)
+        return (0, 0) if answer is None else answer
 
     def solution_picker(self, solution):
         """ Filters out non-credible solutions.
@@ -221,36 +501,25 @@ class school:
                 and changes the self.first attribute to 1, indicating that this procedure took place.
         """
 
-        self.first = np.array(0).reshape(1, 1)
+        self.first = 0
         if solmulti.shape[0] > 1:
-            self.first = np.array(1).reshape(1, 1)
+            self.first = 1
             return solmulti[0]
         else:
             return solmulti
 
-    def filter(self, comparisons):
-
+    def filter_rows(self):
         """ Defines an information status and divides the observations.
 
             According to the information available in the original school, it is classified as having Complete
             information (Complete), Nothing (FullNaN), or partial (MunNaN or DaneNaN). Using this categories the
             observations are divided in two groups that are later used to compare.
 
-            Parameters
-            -------------
-            comparisons: A NumPy 2D-array that contains the information of all the schools that are available for
-                         comparison.
-                         Each row of the array is thought as a school. And has the same column-order as the original:
-                         [Name, Municipality, School's DANE code, School's ID].
-
-
             Returns
             -------------
-            with_codes: a NumPy 2D-array that contains the schools that have the same information (either DANE or
-                             municipality) as the original school.
-
-            with_na: a NumPy 2D-array that contains the schools that do not have the same information as the
-                          original school.
+            with_codes: Sorted row numbers of the schools that have the same information (either DANE or
+                        municipality) as the original school.
+            with_na: Sorted row numbers of the rest of the schools.
 
         """
 
@@ -260,79 +529,926 @@ class school:
         #   2. FullNaN : DANE and MUN are NaN.
         #   3. DaneNaN : DANE is NaN
         #   4. Complete: DANE and MUN are not NaN
+        #
+        # The rows that share the codes are looked up in the comparison_index instead of comparing every row of the
+        # comparison database against the original school.
+
+        comparisons = self.comparisons
+        use_jornada = self.av_meet and not pd.isna(self.jornada)
 
         if pd.isna(self.mun_original) and not pd.isna(self.dane_schoriginal):
 
             self.status = "MunNan"
 
-            if self.av_meet and not pd.isna(self.jornada):
-                condition = (comparisons[:, 2] == self.dane_schoriginal) & (comparisons[:, 4] == self.jornada)
+            if use_jornada:
+                rows = comparisons.lookup("dane_jornada", (self.dane_schoriginal, self.jornada))
             else:
-                condition = comparisons[:, 2] == self.dane_schoriginal
-
-            with_codes = comparisons[condition]
-            with_na = comparisons[~condition]
-
-            if len(with_codes) == 0 and len(with_na) != 0:
-                with_codes = with_na
-                return with_codes, with_na
-            elif len(with_na) == 0 and len(with_codes) != 0:
-                with_na = with_codes
-                return with_codes, with_na
-            elif len(with_codes) == 0 and len(with_na) == 0:
-                return comparisons, comparisons
-            else:
-                return with_codes, with_na
+                rows = comparisons.lookup("dane", self.dane_schoriginal)
+
+            return comparisons.partition(rows)
 
         elif pd.isna(self.mun_original) and pd.isna(self.dane_schoriginal):
             self.status = "FulNaN"
-            return comparisons, comparisons
+            return comparisons.all_rows, comparisons.all_rows
 
         elif pd.isna(self.dane_schoriginal) and not pd.isna(self.mun_original):
             self.status = "DaneNaN"
 
-            if self.av_meet and not pd.isna(self.jornada):
-                condition = (comparisons[:, 1] == self.mun_original) & (comparisons[:, 4] == self.jornada)
-            else:
-                condition = comparisons[:, 2] == self.mun_original
-
-            with_codes = comparisons[condition]
-            with_na = comparisons[~condition]
-
-            if len(with_codes) == 0 and len(with_na) != 0:
-                with_codes = with_na
-                return with_codes, with_na
-            elif len(with_na) == 0 and len(with_codes) != 0:
-                with_na = with_codes
-                return with_codes, with_na
-            elif len(with_codes) == 0 and len(with_na) == 0:
-                return comparisons, comparisons
+            if use_jornada:
+                rows = comparisons.lookup("mun_jornada", (self.mun_original, self.jornada))
             else:
-                return with_codes, with_na
+                # Without meeting time, the municipality is looked up among the DANE codes.
+                rows = comparisons.lookup("dane", self.mun_original)
+
+            return comparisons.partition(rows)
 
         else:
             self.status = "Complete"
 
-            condition = (comparisons[:, 1] == self.mun_original) | (comparisons[:, 2] == self.dane_schoriginal)
-            if self.av_meet and not pd.isna(self.jornada):
-                condition = condition & (comparisons[:, 4] == self.jornada)
-
-            with_codes = comparisons[condition]
-            with_na = comparisons[~condition]
-
-            if len(with_codes) == 0 and len(with_na) != 0:
-                with_codes = with_na
-                return with_codes, with_na
-            elif len(with_na) == 0 and len(with_codes) != 0:
-                with_na = with_codes
-                return with_codes, with_na
-            elif len(with_codes) == 0 and len(with_na) == 0:
-                return comparisons, comparisons
+            if use_jornada:
+                rows = np.union1d(comparisons.lookup("mun_jornada", (self.mun_original, self.jornada)),
+                                  comparisons.lookup("dane_jornada", (self.dane_schoriginal, self.jornada)))
             else:
-                return with_codes, with_na
+                rows = np.union1d(comparisons.lookup("mun", self.mun_original),
+                                  comparisons.lookup("dane", self.dane_schoriginal))
+
+            return comparisons.partition(rows)
+
+
+class comparison_index:
+    """ Blocking index over the comparison database.
+
+        school.filter needs, for every original school, the comparison schools that share its municipality and/or
+        DANE code (and meeting time, if available). Instead of comparing the whole database against each school, the
+        index groups the row numbers of the comparison database by those keys once, so that each school only has to
+        look them up.
+
+        Parameters:
+        ---------------------
+        comparisons: A NumPy 2D-array with the schools available for comparison, in the same column-order as the
+                     original: [Name, Municipality, School's DANE code, School's ID, (Jornada)], or a school_table.
+        groups: If comparisons is a school_table, its blocking_groups, if they're already available (default = None).
+
+        Attributes:
+        ---------------------
+            comparisons: The comparison database itself.
+            size: Number of schools in the comparison database.
+            keys: A dictionary with one table per blocking key ("mun", "dane", "mun_jornada", "dane_jornada") and
+                  one for the names ("name"). Each table maps the value of the key to the sorted row numbers that
+                  have it. Missing values are never indexed, as they never match.
+
+    """
+    def __init__(self, comparisons, groups=None):
+        self.comparisons = comparisons
+        self.size = comparisons.shape[0]
+        self.all_rows = np.arange(self.size)
+        if isinstance(comparisons, school_table):
+            self.names = comparisons.names
+            self.keys = comparisons.blocking_keys(groups)
+            return
+
+        self.names = comparisons[:, 0]
+        self.keys = {"mun": self.group(comparisons[:, 1]),
+                     "dane": self.group(comparisons[:, 2]),
+                     "name": self.group(comparisons[:, 0])}
+        if comparisons.shape[1] > 4:
+            self.keys["mun_jornada"] = self.group(comparisons[:, 1], comparisons[:, 4])
+            self.keys["dane_jornada"] = self.group(comparisons[:, 2], comparisons[:, 4])
+
+    @staticmethod
+    def group(*columns):
+        """ Maps each (non-missing) value of the given columns to the row numbers where it appears.
+
+            Parameters
+            -------------
+            columns: One or more columns of the comparison database. If there is more than one, the key is the
+                     tuple of their values.
+
+            Returns
+            -------------
+                A dictionary {key: sorted NumPy array of row numbers}.
+        """
+        table = {}
+        for row, values in enumerate(zip(*columns)):
+            if any(pd.isna(value) for value in values):
+                continue
+            key = values[0] if len(values) == 1 else values
+            table.setdefault(key, []).append(row)
+        return {key: np.array(rows, dtype=np.intp) for key, rows in table.items()}
+
+    @staticmethod
+    def group_codes(keys, *codes):
+        """ The same as group, for columns of integer codes (MISSING when the value is missing).
+
+            Parameters
+            -------------
+            keys: A function that turns the codes of a row into its key.
+            codes: One or more NumPy arrays of codes.
+
+            Returns
+            -------------
+                A dictionary {key: sorted NumPy array of row numbers}.
+        """
+        return comparison_index.code_table(keys, *comparison_index.code_groups(*codes))
+
+    @staticmethod
+    def code_groups(*codes):
+        """ Groups the row numbers by the values of one or more columns of integer codes (see group_codes).
+
+            Returns
+            -------------
+            distinct: A 2D-array with the distinct values of the codes (one row per group).
+            rows: The row numbers, sorted by group (and sorted within each group).
+            ends: The position in rows where each group ends.
+        """
+        rows = np.flatnonzero(np.logical_and.reduce([code != MISSING for code in codes]))
+        if len(rows) == 0:
+            return np.empty((0, len(codes)), dtype=np.int64), rows, np.empty(0, dtype=np.intp)
+        distinct, inverse = np.unique(np.column_stack([code[rows] for code in codes]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        return distinct, rows[np.argsort(inverse, kind="stable")], np.cumsum(np.bincount(inverse))
+
+    @staticmethod
+    def code_table(keys, distinct, rows, ends):
+        """ Turns the groups of code_groups into the dictionary of group_codes. """
+        starts = [0] + ends[:-1].tolist()
+        return {keys(*values): rows[start:end] for values, start, end in zip(distinct.tolist(), starts, ends.tolist())}
+
+    def take(self, rows):
+        """ Returns the schools in rows, as a NumPy 2D-array with the column-order of the comparison database. """
+        return self.comparisons.take(rows, axis=0)
+
+    def lookup(self, key, value):
+        """ Returns the sorted row numbers of the comparison schools whose key equals value. """
+        if key not in self.keys:
+            raise ValueError("The comparison database has no meeting time (Jornada) column.")
+        return self.keys[key].get(value, np.empty(0, dtype=np.intp))
+
+    def partition(self, rows):
+        """ Divides the comparison database in the schools that are in rows and the ones that are not.
+
+            Parameters
+            -------------
+            rows: Sorted row numbers of the schools that share information with the original school.
+
+            Returns
+            -------------
+            with_codes: the row numbers in rows.
+            with_na: the row numbers of the rest of the schools.
+
+            If either group is empty, both are all the rows of the comparison database.
+        """
+        if len(rows) == 0 or len(rows) == self.size:
+            return self.all_rows, self.all_rows
+
+        outside = np.ones(self.size, dtype=bool)
+        outside[rows] = False
+        return rows, self.all_rows[outside]
+
+    def same_name(self, rows, name):
+        """ Returns the row numbers (among rows) of the schools whose name is exactly name. """
+        if pd.isna(name):
+            return rows[:0]
+        return self.within(self.keys["name"].get(name, rows[:0]), rows)
+
+    @staticmethod
+    def within(candidates, rows):
+        """ Returns the candidates (sorted row numbers) that are also in rows (sorted row numbers). """
+        if len(candidates) == 0 or len(rows) == 0:
+            return candidates[:0]
+        positions = np.minimum(np.searchsorted(rows, candidates), len(rows) - 1)
+        return candidates[rows[positions] == candidates]
+
+
+class prepared_comparison(comparison_index):
+    """ Comparison index that also keeps the school names already processed for the Set Ratio.
+
+        FuzzyWuzzy's extractOne cleans, splits and sorts every name it compares. As the comparison names are the same
+        for every original school, this is done only once here: each distinct processed name is stored together with
+        its set and sorted tuple of tokens, and extract_one scores each distinct name once per original school.
+        The scores (and the chosen school) are exactly the ones given by extractOne with fuzz.token_set_ratio.
+
+        When there are many candidates (as in the na_choice search, or when the school has neither municipality nor
+        DANE code), only a shortlist of them is scored. An inverted index from tokens to names gives, for each
+        candidate, the length of the tokens it shares with the query, and a count of characters per name gives the
+        most characters two names can have in common. With them, an upper bound of the Set Ratio is computed for every
+        candidate, and candidates are scored from the highest bound down (and, among equal bounds, the ones sharing
+        rarer tokens first) until no remaining candidate can beat the best score found. The answer is then exactly
+        the one of the full search.
+
+        Parameters:
+        ---------------------
+        comparisons: The same as comparison_index.
+        floor: Candidates whose bound is below floor are never scored (default = 0). If the best score is at least
+               floor, the answer is still exact. If no candidate can reach it, the search returns (0, 0).
+        limit: Maximum number of distinct names scored per search (default = None, no limit). If it's reached, the
+               best name found so far is returned, so the answer may not be exact.
+        shortlist_from: Searches with fewer distinct names than this are scored in full (default = 64).
+        exact_names: If True, school_matcher.match first looks for the schools whose processed name is exactly the
+                     one of the original school (default = True). See school_matcher.match.
+        accept_score: If the av_choice search of school_matcher.match reaches this score, the na_choice search is
+                      skipped, and otherwise it only looks for names that score at least as much (default = None,
+                      both searches are always complete). See school_matcher.match.
+
+        Attributes:
+        ---------------------
+            name_ids: For each row, the number of its processed name.
+            processed: The distinct processed names.
+            processed_ids: A dictionary {processed name: its number}.
+            name_rows: The sorted row numbers of each processed name.
+            sorted_rows: All the row numbers, sorted by processed name (and by row number within each name).
+            token_sets: The set of tokens of each processed name.
+            tokens: The sorted tuple of tokens of each processed name.
+            lengths: The length of the sorted tokens of each name, joined by spaces.
+            histograms: The number of times each character appears in them (see char_histogram).
+            postings: A dictionary {token: numbers of the names that contain it}.
+            weights: A dictionary {token: weight}. Rare tokens weigh more (log of the inverse frequency).
+
+    """
+    def __init__(self, comparisons, floor=0, limit=None, shortlist_from=64, exact_names=True, accept_score=None):
+        comparison_index.__init__(self, comparisons)
+        self.configure(floor, limit, shortlist_from, exact_names, accept_score)
+
+        processed = [utils.full_process(name, force_ascii=True) for name in self.names]
+        self.name_ids, processed = pd.factorize(np.array(processed, dtype=object))
+        self.sorted_rows = np.argsort(self.name_ids, kind="stable")
+        self.set_names(list(processed))
+
+        self.lengths = np.array([len(" ".join(tokens)) for tokens in self.tokens], dtype=np.int64)
+        self.histograms = np.array([char_histogram(tokens) for tokens in self.tokens], dtype=np.int64)
+        self.histograms = self.histograms.reshape(len(self.tokens), len(HISTOGRAM_CHARS) + 1).astype(np.int16)
+
+        postings = {}
+        for name_id, tokens in enumerate(self.tokens):
+            for token in tokens:
+                postings.setdefault(token, []).append(name_id)
+        self.postings = {token: np.array(ids, dtype=np.intp) for token, ids in postings.items()}
+        self.weights = {token: np.log(len(self.tokens) / len(ids)) for token, ids in postings.items()}
+
+    def configure(self, floor=0, limit=None, shortlist_from=64, exact_names=True, accept_score=None):
+        """ Sets the options of the searches (see the parameters of prepared_comparison). """
+        self.floor = floor
+        self.limit = limit
+        self.shortlist_from = shortlist_from
+        self.exact_names = exact_names
+        self.accept_score = accept_score
+
+    def set_names(self, processed):
+        """ Sets the distinct processed names, and what is derived from them and from name_ids and sorted_rows. """
+        self.processed = processed
+        self.processed_ids = {name: name_id for name_id, name in enumerate(self.processed)}
+        ends = np.cumsum(np.bincount(self.name_ids, minlength=len(self.processed))).tolist()
+        self.name_rows = [self.sorted_rows[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        self.token_sets = [frozenset(name.split()) for name in self.processed]
+        self.tokens = [tuple(sorted(tokens)) for tokens in self.token_sets]
+
+    def save(self, folder):
+        """ Saves the prepared_comparison of a school_table in folder, with one .npy file per array, so that it can
+            be memory-mapped by load. The strings are saved as their UTF-8 bytes (see string_arrays).
 
+            Returns
+            -------------
+                A dictionary with the names of the arrays ("arrays"), the blocking keys ("keys"), the categories
+                of the meeting time ("categories", None if there is no meeting time) and the integer columns of the
+                table ("integers"), which load needs.
+        """
+        table = self.comparisons
+        if not isinstance(table, school_table):
+            raise ValueError("Only the prepared_comparison of a school_table can be saved.")
+
+        tokens = list(self.postings)
+        arrays = {"mun": table.mun, "dane": table.dane, "ids": table.ids, "name_ids": self.name_ids,
+                  "sorted_rows": self.sorted_rows, "lengths": self.lengths, "histograms": self.histograms,
+                  "postings": np.concatenate([self.postings[token] for token in tokens] + [np.empty(0, np.intp)]),
+                  "postings_ends": np.cumsum([len(self.postings[token]) for token in tokens], dtype=np.int64)}
+        arrays.update(string_arrays("names", table.names))
+        arrays.update(string_arrays("processed", self.processed))
+        arrays.update(string_arrays("tokens", tokens))
+        groups = table.blocking_groups()
+        for key, (distinct, rows, ends) in groups.items():
+            arrays.update({key + "_distinct": distinct, key + "_rows": rows, key + "_ends": ends})
+        categories = None
+        if table.jornada is not None:
+            arrays["jornada"] = np.asarray(table.jornada.codes)
+            categories = list(table.jornada.categories)
+
+        os.makedirs(folder, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(folder, name + ".tmp.npy"), array)
+            os.replace(os.path.join(folder, name + ".tmp.npy"), os.path.join(folder, name + ".npy"))
+        return {"arrays": sorted(arrays), "keys": sorted(groups), "categories": categories,
+                "integers": list(table.integers)}
+
+    @classmethod
+    def load(cls, folder, saved, **options):
+        """ Maps a prepared_comparison saved in folder: the arrays are memory-mapped instead of read, and only the
+            strings and the dictionaries of the index are built again.
 
-def do_match(original_db, comparison_db, deb=0, deb2=0, doc="matcher.xlsx", partial=True, freq=10000, av_meet=False):
+            Parameters
+            -------------
+            folder: The folder given to save.
+            saved: The dictionary returned by save.
+            options: The keyword arguments of prepared_comparison (floor, limit...).
+
+            Returns
+            -------------
+                The prepared_comparison, whose comparisons are a school_table.
+        """
+        arrays = {name: np.asarray(np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+                  for name in saved["arrays"]}
+        jornada = None
+        if saved["categories"] is not None:
+            jornada = pd.Categorical.from_codes(arrays["jornada"], saved["categories"])
+        table = school_table(read_strings(arrays, "names"), arrays["mun"], arrays["dane"], arrays["ids"], jornada,
+                             saved["integers"])
+        groups = {key: (arrays[key + "_distinct"], arrays[key + "_rows"], arrays[key + "_ends"])
+                  for key in saved["keys"]}
+
+        prepared = cls.__new__(cls)
+        comparison_index.__init__(prepared, table, groups)
+        prepared.configure(**options)
+        prepared.name_ids = arrays["name_ids"]
+        prepared.sorted_rows = arrays["sorted_rows"]
+        prepared.set_names(list(read_strings(arrays, "processed")))
+        prepared.lengths = arrays["lengths"]
+        prepared.histograms = arrays["histograms"]
+
+        tokens = read_strings(arrays, "tokens")
+        ends = arrays["postings_ends"].tolist()
+        prepared.postings = {token: arrays["postings"][start:end]
+                             for token, start, end in zip(tokens, [0] + ends[:-1], ends)}
+        prepared.weights = {token: np.log(len(prepared.tokens) / len(ids)) for token, ids in prepared.postings.items()}
+        return prepared
+
+    def extract_one(self, query, rows, floor=None, limit=None):
+        """ Finds the closest name to query among the given rows.
+
+            Parameters
+            -------------
+            query: The name of the original school.
+            rows: Row numbers of the comparison schools that are considered (it must not be empty).
+            floor, limit: If given, they replace the ones of the prepared_comparison.
+
+            Returns
+            -------------
+                A tuple (name, score), like extractOne. If several names have the best score, the first one is
+                returned.
+        """
+        return self.search(prepare_query(query), self.block(rows), floor, limit)
+
+    def extract_many(self, queries, rows, floors=None, limit=None):
+        """ Finds the closest name to each query among the same rows.
+
+            It gives the same answers as calling extract_one for each query, but the names in rows are gathered only
+            once (see block), and the queries that are the same once processed are searched only once.
+
+            Parameters
+            -------------
+            queries: The names of the original schools.
+            rows: Row numbers of the comparison schools that are considered (it must not be empty).
+            floors: If given, the floor of the search of each query (None for the one of the prepared_comparison).
+            limit: The same as extract_one.
+
+            Returns
+            -------------
+                A list with the tuple (name, score) of each query.
+        """
+        block = self.block(rows)
+        answers = {}
+        found = []
+        for k, query in enumerate(queries):
+            prepared = prepare_query(query)
+            floor = None if floors is None else floors[k]
+            if (prepared[0], floor) not in answers:
+                answers[prepared[0], floor] = self.search(prepared, block, floor, limit)
+            found.append(answers[prepared[0], floor])
+        return found
+
+    def block(self, rows):
+        """ Gathers the distinct names in rows, which every search among them needs.
+
+            When rows is a large part of the comparison database (as in the na_choice search), the names are taken
+            in the order of sorted_rows instead of sorting the name numbers of rows.
+
+            Returns
+            -------------
+                A tuple (distinct, first, lengths, histograms) with the distinct name numbers, the first row (among
+                rows) with each of them, and their lengths and histograms.
+        """
+        if len(rows) * 8 < self.size:
+            distinct, first = np.unique(self.name_ids[rows], return_index=True)
+            first = rows[first]
+        else:
+            inside = np.zeros(self.size, dtype=bool)
+            inside[rows] = True
+            kept = self.sorted_rows[inside[self.sorted_rows]]
+            ids = self.name_ids[kept]
+            starts = np.ones(len(kept), dtype=bool)
+            starts[1:] = ids[1:] != ids[:-1]
+            distinct, first = ids[starts], kept[starts]
+        return distinct, first, self.lengths[distinct], self.histograms[distinct]
+
+    def search(self, prepared, block, floor=None, limit=None):
+        """ The search of extract_one, for a prepared query (see prepare_query) and a block of names. """
+        floor = self.floor if floor is None else floor
+        limit = self.limit if limit is None else limit
+        distinct, first = block[:2]
+
+        if len(distinct) < self.shortlist_from and floor <= 0 and limit is None:
+            return self.extract_all(prepared, block)
+
+        bounds, weights = self.bounds(prepared, block)
+        scored = 0
+        if limit is None:
+            # The name with the highest bound gives a score that the answer must reach, so the names whose bound is
+            # lower are left out before sorting (they would never be scored).
+            top = np.argmax(bounds)
+            kept = np.flatnonzero(bounds >= max(self.score(prepared, distinct[top]), floor))
+            distinct, first, bounds, weights = distinct[kept], first[kept], bounds[kept], weights[kept]
+            scored = 1
+        order = np.lexsort((first, -weights, -bounds))
+
+        best_score, best_first = -1, -1
+        for k in order:
+            if bounds[k] < max(best_score, floor) or (limit is not None and scored >= limit):
+                break
+            if bounds[k] == best_score and first[k] > best_first:
+                continue
+            score = self.score(prepared, distinct[k])
+            scored += 1
+            if score > best_score or (score == best_score and first[k] < best_first):
+                best_score, best_first = score, first[k]
+
+        self.scored = scored
+        if best_score < 0 or best_score < floor:
+            return 0, 0
+        return self.names[best_first], best_score
+
+    def top(self, prepared, block, k):
+        """ The k best names of a block (see block) for a prepared query (see prepare_query), as in search.
+
+            Returns
+            -------------
+                A list with (score, first row) for each name, from the best down. Among names with the same score,
+                the one with the first row goes first.
+        """
+        distinct, first = block[:2]
+        if len(distinct) <= max(k, self.shortlist_from):
+            scores = np.array([self.score(prepared, name_id) for name_id in distinct], dtype=np.int64)
+            order = np.lexsort((first, -scores))[:k]
+            return [(scores[j], first[j]) for j in order]
+
+        bounds, weights = self.bounds(prepared, block)
+        # The k names with the highest bounds give a score that the k-th answer must reach (as in search).
+        highest = np.argpartition(-bounds, k - 1)[:k]
+        reach = min(self.score(prepared, distinct[j]) for j in highest)
+        kept = np.flatnonzero(bounds >= reach)
+        distinct, first, bounds, weights = distinct[kept], first[kept], bounds[kept], weights[kept]
+
+        best = []
+        for j in np.lexsort((first, -weights, -bounds)):
+            if len(best) == k and bounds[j] < -best[-1][0]:
+                break
+            found = (-self.score(prepared, distinct[j]), first[j])
+            if len(best) < k or found < best[-1]:
+                best.insert(bisect.bisect(best, found), found)
+                del best[k:]
+        return [(-score, row) for score, row in best]
+
+    def reaches(self, prepared, block, score, excluded=None, first=()):
+        """ Returns True if some name of a block (see block) scores at least score against a prepared query (see
+            prepare_query). The names are scored from the highest bound down, and the search stops at the first one
+            that does.
+
+            excluded: Sorted row numbers that are left out: a name only counts if some of its rows is not among them
+                      (default = None).
+            first: Numbers of names of the block that are tried before the others (default = (), none).
+        """
+        distinct = block[0]
+        if score > 100:
+            return False
+        if excluded is None:
+            excluded = distinct[:0]
+
+        def reached(name_id):
+            rows = self.name_rows[name_id]
+            return len(self.within(rows, excluded)) < len(rows) and self.score(prepared, name_id) >= score
+
+        if any(reached(name_id) for name_id in first):
+            return True
+
+        # The names that share the rarest tokens of the query usually reach the score, so they are tried first.
+        tokens = [token for token in prepared[2] if token in self.postings]
+        for token in sorted(tokens, key=lambda token: -self.weights[token]):
+            if len(self.postings[token]) > self.shortlist_from:
+                break
+            if any(reached(name_id) for name_id in self.within(self.postings[token], distinct)):
+                return True
+
+        bounds, weights = self.bounds(prepared, block)
+        kept = np.flatnonzero(bounds >= score)
+        return any(reached(distinct[k]) for k in kept[np.lexsort((-weights[kept], -bounds[kept]))])
+
+    def above(self, prepared, block, score):
+        """ Returns the names of a block (see block) that score more than score against a prepared query (see
+            prepare_query), as two arrays: their positions in the block and their scores. Only the names whose bound
+            is above score are scored.
+        """
+        distinct = block[0]
+        if len(distinct) < self.shortlist_from:
+            kept = np.arange(len(distinct))
+        else:
+            kept = np.flatnonzero(self.bounds(prepared, block)[0] > score)
+        scores = np.array([self.score(prepared, distinct[k]) for k in kept], dtype=np.int64)
+        return kept[scores > score], scores[scores > score]
+
+    def exact_rows(self, query, rows):
+        """ Returns the row numbers (among rows) of the schools whose processed name is exactly the processed query.
+
+            Names that are empty once processed are never considered exact matches.
+        """
+        processed = prepare_query(query)[0]
+        if not processed or processed not in self.processed_ids:
+            return rows[:0]
+        return self.within(self.name_rows[self.processed_ids[processed]], rows)
+
+    def extract_all(self, prepared, block):
+        """ Scores every distinct name of a block (see extract_one). """
+        distinct, first = block[:2]
+        scores = np.array([self.score(prepared, name_id) for name_id in distinct], dtype=np.int64)
+
+        self.scored = len(distinct)
+        best = scores.max()
+        return self.names[first[scores == best].min()], best
+
+    def bounds(self, prepared, block):
+        """ Upper bounds of the Set Ratio between the prepared query and the names of a block (see block).
+
+            The Set Ratio is the best of three ratios: intersection vs. query tokens, intersection vs. comparison
+            tokens, and query tokens vs. comparison tokens. A ratio is 2 * M / T, where T is the sum of the lengths
+            and M the number of matching characters, which is at most the length of the shorter string and at most
+            the number of characters both strings have in common.
+
+            Returns
+            -------------
+            bounds: The bound of each name, as an integer score.
+            weights: The weight of the tokens each name shares with the query.
+        """
+        processed, token_set, tokens, length, histogram = prepared
+        distinct, other, histograms = block[0], block[2], block[3]
+
+        shared = np.zeros(len(self.processed), dtype=np.int64)
+        weights = np.zeros(len(self.processed))
+        for token in tokens:
+            if token in self.postings:
+                shared[self.postings[token]] += len(token) + 1
+                weights[self.postings[token]] += self.weights[token]
+        shared = np.maximum(shared[distinct] - 1, 0)
+        common = np.minimum(histograms, np.minimum(histogram, np.iinfo(np.int16).max).astype(np.int16))
+        common = common.sum(axis=1, dtype=np.int64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            best = np.maximum(np.where(shared > 0, 2.0 * shared / (shared + length), 0),
+                              np.where(shared > 0, 2.0 * shared / (shared + other), 0))
+            best = np.maximum(best, np.where(length + other > 0, 2.0 * common / (length + other), 0))
+
+        # Empty names only score (100) against other empty names.
+        best = np.where((length == 0) | (other == 0), (length == 0) & (other == 0), best)
+        return np.ceil(100 * best).astype(np.int64), weights[distinct]
+
+    def score(self, prepared, name_id):
+        """ Set Ratio between a prepared query (see prepare_query) and a processed comparison name. """
+        processed, token_set, tokens = prepared[:3]
+        other = self.processed[name_id]
+        if processed == other:
+            return 100
+        if not processed or not other:
+            return 0
+
+        other_set = self.token_sets[name_id]
+        sorted_sect = " ".join(token for token in tokens if token in other_set)
+        sorted_1to2 = " ".join(token for token in tokens if token not in other_set)
+        sorted_2to1 = " ".join(token for token in self.tokens[name_id] if token not in token_set)
+
+        combined_1to2 = (sorted_sect + " " + sorted_1to2).strip()
+        combined_2to1 = (sorted_sect + " " + sorted_2to1).strip()
+
+        return max(ratio(sorted_sect, combined_1to2), ratio(sorted_sect, combined_2to1),
+                   ratio(combined_1to2, combined_2to1))
+
+
+def shortlist_report(original_db, comparison_db, floors=(0,), limits=(None,), av_meet=False, step=1):
+    """ Measures how often the shortlist of prepared_comparison misses the best match of the na_choice search.
+
+    For each school in original_db, the na_choice search (which is the whole comparison database for the schools
+    without municipality and DANE code) is done scoring every candidate, and then with the shortlist for each
+    combination of floor and limit. A miss is a search in which the shortlist does not give the same name and score.
+
+    Arguments
+    -------------
+    original_db, comparison_db, av_meet: The same as do_match.
+    floors: The values of floor to try.
+    limits: The values of limit to try.
+    step: Only one school every step is used.
+
+    Returns
+    ------------
+        A Pandas DataFrame with one row per combination: the number of searches, misses, the miss rate, and the mean
+        number of candidates (distinct names) and of scored names per search.
+
+    """
+    comparisons = prepared_comparison(comparison_db)
+    settings = [(floor, limit) for floor in floors for limit in limits]
+    misses = dict.fromkeys(settings, 0)
+    scored = dict.fromkeys(settings, 0)
+    searches = candidates = 0
+    current = school_matcher(comparisons, av_meet)
+
+    for original in original_db[::step]:
+        if pd.isna(original[0]):
+            continue
+        current.load(original)
+        av_rows, na_rows = current.filter_rows()
+        block = comparisons.block(na_rows)
+        exact = comparisons.extract_all(prepare_query(current.name_original), block)
+        searches += 1
+        candidates += len(block[0])
+
+        for floor, limit in settings:
+            found = comparisons.extract_one(current.name_original, na_rows, floor=floor, limit=limit)
+            scored[floor, limit] += comparisons.scored
+            if found[1] != exact[1] or not (found[0] == exact[0] or (pd.isna(found[0]) and pd.isna(exact[0]))):
+                misses[floor, limit] += 1
+
+    return pd.DataFrame([{"Floor": floor, "Limit": limit, "Searches": searches, "Misses": misses[floor, limit],
+                          "Miss Rate": misses[floor, limit] / max(searches, 1),
+                          "Candidates": candidates / max(searches, 1),
+                          "Scored": scored[floor, limit] / max(searches, 1)} for floor, limit in settings])
+
+
+# Characters that are counted one by one in char_histogram. The rest are counted together in a last position.
+HISTOGRAM_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789_ "
+_histogram_positions = {char: position for position, char in enumerate(HISTOGRAM_CHARS)}
+
+
+def char_histogram(tokens):
+    """ Counts the characters of the tokens joined by spaces (see HISTOGRAM_CHARS). """
+    histogram = np.zeros(len(HISTOGRAM_CHARS) + 1, dtype=np.int64)
+    for char in " ".join(tokens):
+        histogram[_histogram_positions.get(char, len(HISTOGRAM_CHARS))] += 1
+    return histogram
+
+
+@lru_cache(maxsize=2 ** 16)
+def prepare_query(name):
+    """ Processes an original school name the same way extractOne does before using fuzz.token_set_ratio.
+
+        Returns
+        -------------
+            A tuple (processed name, set of tokens, sorted tuple of tokens, length of the sorted tokens joined by
+            spaces, char_histogram of them). The results are memorized, as the same names appear many times in the
+            original databases.
+    """
+    processed = utils.full_process(utils.full_process(name), force_ascii=True)
+    token_set = frozenset(processed.split())
+    tokens = tuple(sorted(token_set))
+    return processed, token_set, tokens, len(" ".join(tokens)), char_histogram(tokens)
+
+
+def ratio(s1, s2):
+    """ The same as fuzz.ratio for two strings that are already processed. """
+    if s1 == s2:
+        return 100
+    if len(s1) == 0 or len(s2) == 0:
+        return 0
+    return utils.intr(100 * fuzz.SequenceMatcher(None, s1, s2).ratio())
+
+
+# Code used in school_table for missing municipalities, DANE codes and IDs.
+MISSING = -1
+
+
+class school_table:
+    """ A database of schools stored as one typed column per field.
+
+        pd.read_csv(...).values gives a single 2D-array of Python objects, in which the codes are floats (because of
+        the missing values) mixed with strings. A school_table keeps instead the codes as 64-bit integers (MISSING
+        when they are missing), the meeting time as a categorical column and the names as interned strings. It takes
+        much less memory, and the comparison_index is built from it with vectorized operations.
+
+        do_match and school.matcher accept it in place of the NumPy arrays: table[i] gives the i-th school as a row of
+        the same kind (and with the same values) as the ones of the 2D-array, and table[first:last] another table.
+        As in the 2D-array, the codes of a column are integers if pandas reads the column as integers (no missing
+        values nor decimals), and floats otherwise.
+
+        Parameters:
+        ---------------------
+        names: A NumPy array (dtype object) with the names (NaN if missing).
+        mun, dane, ids: NumPy int64 arrays with the municipalities, DANE codes and IDs.
+        jornada: A pd.Categorical with the meeting times, or None if the database doesn't have them.
+        integers: Whether pandas reads the municipality, DANE code and ID columns as integers (three booleans,
+                  default = (False, False, True)).
+
+    """
+    def __init__(self, names, mun, dane, ids, jornada=None, integers=(False, False, True)):
+        self.names = names
+        self.mun = mun
+        self.dane = dane
+        self.ids = ids
+        self.jornada = jornada
+        self.integers = tuple(bool(integer) for integer in integers)
+
+    @property
+    def shape(self):
+        return len(self.names), 4 if self.jornada is None else 5
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return school_table(self.names[item], self.mun[item], self.dane[item], self.ids[item],
+                                None if self.jornada is None else self.jornada[item], self.integers)
+        return self.take([item])[0]
+
+    def take(self, rows, axis=0):
+        """ Returns the schools in rows as a NumPy 2D-array of objects, like pd.read_csv(...).values: the codes
+            are integers or floats (NaN if missing), as their columns (see integers), and the missing meeting times
+            NaN. """
+        rows = np.asarray(rows, dtype=np.intp)
+        table = np.empty((len(rows), self.shape[1]), dtype=object)
+        table[:, 0] = self.names[rows]
+        for column, codes, integer in zip([1, 2, 3], [self.mun[rows], self.dane[rows], self.ids[rows]], self.integers):
+            table[:, column] = codes if integer else np.where(codes == MISSING, np.nan, codes.astype(np.float64))
+        if self.jornada is not None:
+            table[:, 4] = np.asarray(self.jornada[rows], dtype=object)
+        return table
+
+    def to_array(self):
+        """ Returns the whole table as a NumPy 2D-array of objects (see take). """
+        return self.take(np.arange(len(self)))
+
+    def blocking_keys(self, groups=None):
+        """ Returns the tables of the comparison_index (see comparison_index.keys) for this database.
+
+            groups: The result of blocking_groups, if it's already available (for instance, saved with a
+                    prepared_comparison).
+        """
+        if groups is None:
+            groups = self.blocking_groups()
+        names = pd.factorize(self.names)[1]
+        keys = {"mun": comparison_index.code_table(lambda mun: mun, *groups["mun"]),
+                "dane": comparison_index.code_table(lambda dane: dane, *groups["dane"]),
+                "name": comparison_index.code_table(lambda name: names[name], *groups["name"])}
+        if self.jornada is not None:
+            meeting = list(self.jornada.categories)
+            keys["mun_jornada"] = comparison_index.code_table(lambda mun, jornada: (mun, meeting[jornada]),
+                                                              *groups["mun_jornada"])
+            keys["dane_jornada"] = comparison_index.code_table(lambda dane, jornada: (dane, meeting[jornada]),
+                                                               *groups["dane_jornada"])
+        return keys
+
+    def blocking_groups(self):
+        """ Groups the rows by each blocking key, as arrays (see comparison_index.code_groups). The names are
+            grouped by their number in pd.factorize, and the meeting times by their categorical code. """
+        groups = {"mun": comparison_index.code_groups(self.mun),
+                  "dane": comparison_index.code_groups(self.dane),
+                  "name": comparison_index.code_groups(pd.factorize(self.names)[0])}
+        if self.jornada is not None:
+            codes = self.jornada.codes.astype(np.int64)
+            groups["mun_jornada"] = comparison_index.code_groups(self.mun, codes)
+            groups["dane_jornada"] = comparison_index.code_groups(self.dane, codes)
+        return groups
+
+
+def load_schools(path, av_meet=None, chunksize=None):
+    """ Reads one of the Matcher CSV files into a school_table.
+
+    The columns are taken by position: name (nombre), municipality (muni_id), DANE code (cod_dane), ID (id_sede) and
+    meeting time (jornada). The name and meeting time are read with explicit types, and the codes as pandas reads
+    them (the table remembers which columns are integers, see school_table).
+
+    Arguments
+    -------------
+    path: The CSV file.
+    av_meet: If True, the meeting time is read (it must be the fifth column). If False, it's not. By default (None),
+             it's read whenever the file has a fifth column.
+    chunksize: If given, the file is read this number of rows at a time, so that large files never have to be held
+               as a whole in a DataFrame.
+
+    Returns
+    ------------
+        A school_table.
+
+    """
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    if av_meet is None:
+        av_meet = len(columns) > 4
+    columns = columns[:5] if av_meet else columns[:4]
+    types = {columns[0]: object}
+    if av_meet:
+        types[columns[4]] = "category"
+
+    reader = pd.read_csv(path, usecols=columns, dtype=types, chunksize=chunksize)
+    chunks = [reader] if chunksize is None else reader
+
+    names, codes, jornadas = [], [[], [], []], []
+    integers = [True, True, True]
+    for chunk in chunks:
+        names.append(np.array([sys.intern(name) if isinstance(name, str) else np.nan for name in chunk[columns[0]]],
+                              dtype=object))
+        for k, (column, values) in enumerate(zip(columns[1:4], codes)):
+            # Una columna es entera solo si pandas la lee como entera en todo el archivo.
+            integers[k] = integers[k] and pd.api.types.is_integer_dtype(chunk[column])
+            values.append(chunk[column].astype(np.float64).fillna(MISSING).to_numpy(dtype=np.int64))
+        if av_meet:
+            jornadas.append(chunk[columns[4]].array)
+
+    jornada = None
+    if av_meet:
+        jornada = pd.Categorical(union_categoricals(jornadas, ignore_order=True))
+    return school_table(np.concatenate(names), *[np.concatenate(values) for values in codes], jornada=jornada,
+                        integers=integers)
+
+
+# Version of the matcher. It's saved with the prepared comparison databases (see load_prepared), which are built again
+# when it changes, so it must change whenever the way they're built does.
+MATCHER_VERSION = "2.1"
+
+
+def load_prepared(path, av_meet=None, **options):
+    """ Returns the prepared_comparison of one of the Matcher CSV files, saved next to it to be reused.
+
+    The first time, the file is read (see load_schools) and prepared, and the arrays of the prepared_comparison
+    (typed columns, processed names and tokens, and blocking indexes) are saved in a folder next to the file
+    (path without its extension, plus "_prepared", or "_prepared_meet" with the meeting time). The next times, and
+    in every process of a pool, they are memory-mapped instead (see prepared_comparison.load).
+
+    The folder has a manifest with the SHA-256 of the file and the MATCHER_VERSION. If either changed, the folder
+    is built again.
+
+    Arguments
+    -------------
+    path: The CSV file.
+    av_meet: The same as load_schools.
+    options: The keyword arguments of prepared_comparison (floor, limit...). They aren't saved.
+
+    Returns
+    ------------
+        A prepared_comparison, whose comparisons are a school_table.
+
+    """
+    if av_meet is None:
+        av_meet = len(pd.read_csv(path, nrows=0).columns) > 4
+    folder = os.path.splitext(path)[0] + ("_prepared_meet" if av_meet else "_prepared")
+    manifest_file = os.path.join(folder, "manifest.json")
+    source = {"sha256": file_hash(path), "version": MATCHER_VERSION, "av_meet": av_meet}
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+        if all(manifest.get(key) == value for key, value in source.items()):
+            return prepared_comparison.load(folder, manifest, **options)
+
+    prepared = prepared_comparison(load_schools(path, av_meet), **options)
+    manifest = dict(source, **prepared.save(folder))
+    with open(manifest_file + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return prepared
+
+
+def file_hash(path, block=2 ** 20):
+    """ The SHA-256 of a file, as a hexadecimal string. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(block), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def string_arrays(name, strings):
+    """ Encodes strings (NaN when missing) as arrays that can be memory-mapped: the UTF-8 bytes of all of them
+        (name), where each one ends in them (name + "_ends") and which are missing (name + "_missing"). """
+    encoded = [string.encode("utf-8") if isinstance(string, str) else b"" for string in strings]
+    return {name: np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            name + "_ends": np.cumsum([len(string) for string in encoded], dtype=np.int64),
+            name + "_missing": np.array([not isinstance(string, str) for string in strings], dtype=bool)}
+
+
+def read_strings(arrays, name):
+    """ Decodes the strings saved by string_arrays, as a NumPy array of interned strings (dtype object). """
+    data = arrays[name].tobytes()
+    ends = arrays[name + "_ends"].tolist()
+    strings = np.array([sys.intern(data[start:end].decode("utf-8")) for start, end in zip([0] + ends[:-1], ends)],
+                       dtype=object)
+    strings[arrays[name + "_missing"]] = np.nan
+    return strings
+
+
+def do_match(original_db, comparison_db, deb=0, deb2=0, doc="matcher.xlsx", partial=True, freq=10000, av_meet=False,
+             workers=1, exact_names=True, cache_size=None, resume=False, metrics=False, progress=True,
+             accept_score=None, batch=False, excel=True, candidates=0):
     """Realizes the matcher for each school name.
 
     This function creates a school object for each individual school available in the original database. It is mainly
@@ -344,71 +1460,1516 @@ def do_match(original_db, comparison_db, deb=0, deb2=0, doc="matcher.xlsx", part
     original_db: It's the database that contains all the schools. This is used to create the school object.
     comparison_db: It's the database that is going to be used for comparison. It contains the names that are going to
                    be matched.
+    Both databases can be NumPy 2D-arrays (like pd.read_csv(...).values) or school_tables (see load_schools). The
+    comparison database can also be already prepared (see prepare), in which case exact_names and accept_score are
+    not used, or the path of a Matcher CSV file, whose prepared_comparison is saved next to it and reused by the next
+    runs and by every process (see load_prepared).
 
     deb: It's a debugging parameter. It defines when to start the matcher.
     deb2: It's a debugging parameter. It defines when to stop the matcher.
-    doc: It's the name for the final output.
-    partial: Allows for the output of partial results. (Default True)
-    freq: Defines how often the partial results are created. (Only works if partial = True)
+    doc: It's the name for the final output. The rows are written in a CSV file (doc with the extension csv) while the
+         matching goes on, every freq schools (see output_writer).
+    partial: Allows for the output of partial results. (Default True) Every freq schools, the rows found since the
+             previous time are added to a checkpoint_store next to doc (a folder with one file per block of rows),
+             which is removed when the run finishes. If a run is interrupted, the next one must resume it (or the
+             folder must be removed): its blocks are never deleted.
+    freq: Defines how often the rows are written, and the partial results are created.
     av_meet: If ture, it means that the data provided includes the meeting time.
+    workers: Number of processes used for the matching (Default 1). If it's greater than 1, the schools are divided
+             in chunks that are matched in a pool of processes, each of which builds the comparison index only once.
+             The results are the same (and in the same order) as with one process.
+             On Windows, the script that calls do_match must be protected by an if __name__ == "__main__": block.
+    exact_names: If True, the schools with exactly the same name (once processed) among the ones that share the
+                 original school's information are taken without fuzzy search. See school_matcher.match. (Default True)
+                 It's faster, but it changes some matches: an exact name is taken even when choose would have
+                 preferred a single school of the other search (whatever its score) to several schools with that
+                 name, or an earlier name that also scores 100. On 286 schools of 2012 against 2013 without meeting
+                 time, 14 Match IDs change (13 of them in the first case) and 8 accepted matches of the > 95 rule;
+                 False gives the matches of the original matcher.
+    cache_size: The schools with the same name, codes and meeting time as one already matched reuse its match (see
+                match_cache). This is the maximum number of matches remembered (Default None, no limit). If it's 0,
+                every school is matched.
+    resume: If True, and there is a checkpoint_store of a previous run with the same doc, deb, deb2 and av_meet, the
+            matcher starts right after the last school saved in it, and its rows are included in the output.
+            (Default False)
+    metrics: If True, the time and number of calls of each stage of the matcher and the number of candidates of each
+             school are collected (see match_metrics). They are written next to doc (doc without its extension, plus
+             "_metrics.json") and kept in results.attrs["metrics"]. (Default False)
+    progress: If True, a progress line with the number of schools matched, the schools per second and the remaining
+              time is printed (at most once per second). (Default True)
+    accept_score: If the search among the schools that share the original school's information reaches this score,
+                  the search among the rest is skipped; otherwise, the second search only looks for names that score
+                  at least as much. See school_matcher.match. It trades exactness for speed: some schools get
+                  another match (a school of the same municipality or DANE code instead of a single one elsewhere)
+                  and another Similarity, so the matches accepted by the > 95 rule of the id_replace do-files change
+                  (on 600 schools of 2012 against 2013, 96 changed 13 Match IDs). The number of searches skipped and
+                  pruned is printed at the end. (Default None, both searches are always complete)
+    batch: If True, the schools that share their municipality, DANE code and meeting time are matched together (see
+           match_blocks). The results are the same. (Default False)
+    excel: If True, the Excel Spreadsheet doc is written at the end from the CSV file (see csv_to_excel).
+           (Default True)
+    candidates: If it's greater than 0, the best candidates names of each search (and the exact names) are kept
+                for every school, with their scores and whether they share the school's codes (see candidate_table),
+                so that the matches can be decided again with redecide. They are written next to doc (doc without
+                its extension, plus "_candidates.pkl", see pd.read_pickle); a resumed run only has the candidates
+                of the schools it matched. The searches are always complete (even for exact names), so the
+                matching is slower (about three times on the bundled data), and batch is not used. (Default 0)
 
     Returns
     ------------
         This function returns Pandas Dataframe with all the information contained in the school object for each
         school in original_db.
 
-        In addition, it creates an Excel Spreadsheet with it, and if partial = True, then it will also produce one
-        spreadsheet every freq iterations.
+        In addition, it creates a CSV file and an Excel Spreadsheet with it, and if partial = True, then it will also
+        save the results every freq iterations (see checkpoint_store).
 
     """
 
     last = len(original_db)
     if deb2 != 0:
         last = deb2
-    if av_meet:
-        results = np.zeros((1, 12))
+
+    store = None
+    start = deb
+    if partial or resume:
+        store = checkpoint_store(doc, deb, last, av_meet, resume)
+        start = store.next
+
+    results = match_results(last - start, av_meet)
+    saved = 0
+    writer = output_writer(doc, av_meet, excel, store)
+    if start > deb:
+        writer.append(store.to_frame())  # The rows of the run that is resumed.
+
+    options = {"exact_names": exact_names, "accept_score": accept_score}
+    cache = None if cache_size == 0 else match_cache(cache_size)
+    collector = match_metrics() if metrics or accept_score is not None else None
+    line = progress_line(last - start) if progress else None
+    kept = candidate_table(candidates) if candidates > 0 else None
+    if workers > 1:
+        if isinstance(comparison_db, str):
+            load_prepared(comparison_db, av_meet)  # The processes only map it if it's saved before they start.
+        matches = parallel_matches(original_db, comparison_db, start, last, av_meet, workers, options, cache,
+                                   collector, batch, kept)
+    elif kept is not None:
+        matches = match_rows(original_db, prepare(comparison_db, av_meet, **options), start, last, av_meet, cache,
+                             collector, kept)
     else:
-        results = np.zeros((1, 10))
+        match = match_blocks if batch else match_rows
+        matches = match(original_db, prepare(comparison_db, av_meet, **options), start, last, av_meet, cache,
+                        collector)
 
-    for i in range(deb, last):
-        print(i)
-        if pd.isna(original_db[i][0]):
+    for i, match in zip(range(start, last), matches):
+        if match is None:
             pass
         else:
-            results = np.vstack([results, school(original_db[i], av_meet).matcher(comparison_db)])
-            if i == (last-1):
-                results = pd.DataFrame(results)
+            results.write(original_db[i], *match)
+
+        if i % freq == 0 and i > 0:
+            writer.append(results.to_frame(saved), i + 1)
+            saved = results.n
+
+        if line is not None:
+            line.update(i + 1 - start)
+
+    if line is not None:
+        line.close()
+    if cache is not None:
+        print("Repeated schools: {} of {} matched from the cache.".format(cache.hits, cache.hits + cache.misses))
+    if accept_score is not None:
+        searches = collector.searches
+        print("Second searches: {} skipped, {} with a score cutoff ({} of them found nothing above it).".format(
+            searches.get("skipped", 0), searches.get("cutoff", 0) + searches.get("pruned", 0),
+            searches.get("pruned", 0)))
+
+    writer.append(results.to_frame(saved), last)
+    writer.close()
+    if store is None:
+        results = results.to_frame()
+    else:
+        results = store.to_frame()
+        store.remove()
+
+    if metrics:
+        results.attrs["metrics"] = collector.summary()
+        with open(os.path.splitext(doc)[0] + "_metrics.json", "w") as file:
+            json.dump(results.attrs["metrics"], file, indent=1)
+    if kept is not None:
+        kept = kept.to_frame()
+        kept.to_pickle(os.path.splitext(doc)[0] + "_candidates.pkl")
+        print("Candidates: {} rows for {} schools.".format(len(kept), kept["Original"].nunique()))
 
-                if av_meet:
-                    results.columns = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
-                                       "Original Jornada", "Match School Name", "Match Municipality", "Match DANE",
-                                       "Match ID", "Match Jornada", "Similarity", "First"]
+    return results
 
-                else:
-                    results.columns = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
-                                       "Match School Name",    "Match Municipality",    "Match DANE",    "Match ID",
-                                       "Similarity", "First"]
 
-                results.to_excel(doc)
-                results.to_csv(doc[:-4]+"csv")
+class checkpoint_store:
+    """ Saves the results of a long do_match run as it goes, so that it can be resumed.
 
-        if partial and i % freq == 0 and i > 0:
-            name = str(i)+doc
-            to_excel = pd.DataFrame(results)
-            if av_meet:
-                to_excel.columns = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
-                                    "Original Jornada", "Match School Name", "Match Municipality", "Match DANE",
-                                    "Match ID", "Match Jornada", "Similarity", "First"]
+        The rows are saved in blocks (one pickle file per block, holding only the rows found since the previous
+        block) inside a folder named after the output document. A small manifest (manifest.json) records the range of
+        the run and the blocks that were completely written. A block only counts once the manifest says so, and the
+        manifest is replaced atomically, so a run that is interrupted while saving loses at most that block.
 
-            else:
-                to_excel.columns = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
-                                    "Match School Name", "Match Municipality", "Match DANE", "Match ID",
-                                    "Similarity", "First"]
-            to_excel.to_excel(name)
+        Parameters:
+        ---------------------
+        doc: The name of the final output of do_match. The folder is doc without its extension, plus "_checkpoints".
+        deb, last: The range of rows of the original database of the run.
+        av_meet: If True, the results include the meeting time.
+        resume: If True, and the folder has the manifest of a run with the same range and av_meet, its blocks are
+                kept (default = False). Blocks already saved are never deleted: if the folder has some and resume is
+                False, or they're from a run with another range or av_meet, a ValueError is raised. The folder is
+                removed once the run finishes (see remove).
+
+        Attributes:
+        ---------------------
+            directory: The folder.
+            manifest: A dictionary with the range of the run, the blocks ({"file", "first", "next", "rows"}) and the
+                      next row of the original database to be matched ("next").
+            next: The same as manifest["next"].
+
+    """
+    def __init__(self, doc, deb, last, av_meet=False, resume=False):
+        self.directory = os.path.splitext(doc)[0] + "_checkpoints"
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+        self.av_meet = av_meet
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest = None
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as file:
+                manifest = json.load(file)
+
+        run = {"deb": deb, "last": last, "av_meet": av_meet}
+        if manifest is not None and len(manifest["chunks"]) > 0:
+            if not all(manifest[key] == value for key, value in run.items()):
+                raise ValueError("{} has {} blocks of another run (rows {} to {}, av_meet={}). Remove the folder to "
+                                 "start this one.".format(self.directory, len(manifest["chunks"]), manifest["deb"],
+                                                          manifest["last"], manifest["av_meet"]))
+            if not resume:
+                raise ValueError("{} has {} blocks of a run that didn't finish (up to row {}). Use resume=True to "
+                                 "continue it, or remove the folder to start again.".format(
+                                     self.directory, len(manifest["chunks"]), manifest["next"]))
+            self.manifest = manifest
+            print("Resuming from row {} ({} blocks saved).".format(manifest["next"], len(manifest["chunks"])))
+        else:
+            self.manifest = dict(run, next=deb, chunks=[])
+            self.write_manifest()
+
+    @property
+    def next(self):
+        return self.manifest["next"]
+
+    def append(self, rows, next_row):
+        """ Saves a block of rows (a DataFrame), after which the run continues at next_row. """
+        if len(rows) == 0:
+            self.manifest["next"] = next_row
+            self.write_manifest()
+            return
+
+        name = "chunk_{:05d}.pkl".format(len(self.manifest["chunks"]))
+        path = os.path.join(self.directory, name)
+        rows.to_pickle(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+        self.manifest["chunks"].append({"file": name, "first": self.manifest["next"], "next": next_row,
+                                        "rows": len(rows)})
+        self.manifest["next"] = next_row
+        self.write_manifest()
+
+    def write_manifest(self):
+        with open(self.manifest_file + ".tmp", "w") as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def to_frame(self):
+        """ Returns all the rows saved, in order, as a single DataFrame. """
+        chunks = [pd.read_pickle(os.path.join(self.directory, chunk["file"])) for chunk in self.manifest["chunks"]]
+        if len(chunks) == 0:
+            return match_results(0, self.av_meet).to_frame()
+        return pd.concat(chunks, ignore_index=True)
+
+    def remove(self):
+        """ Removes the folder, once the run has finished and its rows are written. """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class output_writer:
+    """ Writes the results of do_match in a background thread, while the matching goes on.
+
+        The blocks of rows are appended to a CSV file as soon as they're finished (and saved in the checkpoint_store,
+        if there is one), in the same order they were given. At the end, the Excel Spreadsheet is written from the
+        CSV file, a block of rows at a time (see csv_to_excel), so the whole workbook is never in memory.
+
+        The CSV file has the same rows as DataFrame.to_csv of the whole results, but the IDs of each block are only
+        written as floats if that block has a missing ID.
+
+        Parameters:
+        ---------------------
+        doc: The name of the Excel Spreadsheet. The CSV file is doc with the extension csv.
+        av_meet: if True, the rows include the meeting time (default = False).
+        excel: If True, the Excel Spreadsheet is written when the writer is closed (default = True).
+        store: A checkpoint_store, or None (default = None).
+
+        Attributes:
+        ---------------------
+            path: The CSV file.
+            rows: Number of rows written so far.
+
+    """
+    def __init__(self, doc, av_meet=False, excel=True, store=None):
+        self.doc = doc
+        self.path = doc[:-4]+"csv"
+        self.av_meet = av_meet
+        self.excel = excel
+        self.store = store
+        self.rows = 0
+        self.error = None
+        self.file = open(self.path, "w", newline="", encoding="utf-8")
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, rows, next_row=None):
+        """ Queues a block of rows (a DataFrame). If next_row is given and there is a checkpoint_store, the block is
+            also saved in it, after which the run continues at next_row (see checkpoint_store.append). """
+        if self.error is not None:
+            raise self.error
+        self.tasks.put((rows, next_row))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error is not None:
+                continue
+            rows, next_row = task
+            try:
+                self.write(rows)
+                if next_row is not None and self.store is not None:
+                    self.store.append(rows, next_row)
+            except Exception as error:
+                self.error = error
+
+    def write(self, rows):
+        written = rows.set_axis(pd.RangeIndex(self.rows, self.rows + len(rows)), axis=0)
+        if self.rows == 0 and len(rows) > 0:
+            written.to_csv(self.file)
+        elif len(rows) > 0:
+            written.to_csv(self.file, header=False)
+        self.file.flush()
+        self.rows += len(rows)
+
+    def close(self):
+        """ Waits until every block is written, and writes the Excel Spreadsheet (if excel is True). """
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is None and self.rows == 0:
+            match_results(0, self.av_meet).to_frame().to_csv(self.file)
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+        if self.excel:
+            csv_to_excel(self.path, self.doc)
+
+
+def csv_to_excel(path, doc, chunksize=10000):
+    """ Writes a CSV file of results (as written by output_writer) in an Excel Spreadsheet, with the same layout as
+    DataFrame.to_excel.
+
+    The file is read chunksize rows at a time, and the workbook is written with the constant_memory mode of
+    xlsxwriter, which writes each row to disk as soon as the next one starts.
+
+    Arguments
+    -------------
+    path: The CSV file.
+    doc: The name of the Excel Spreadsheet.
+    chunksize: Number of rows read at a time. (Default 10000)
+
+    """
+    import xlsxwriter
+
+    columns = pd.read_csv(path, index_col=0, nrows=0).columns
+    text = {column: str for column in columns if match_results.dtypes.get(column) is object}
+    workbook = xlsxwriter.Workbook(doc, {"constant_memory": True})
+    sheet = workbook.add_worksheet("Sheet1")
+    header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for column, name in enumerate(columns, 1):
+        sheet.write_string(0, column, name, header)
+
+    row = 0
+    for chunk in pd.read_csv(path, index_col=0, dtype=text, chunksize=chunksize):
+        for index, values in zip(chunk.index, chunk.itertuples(index=False)):
+            row += 1
+            sheet.write_number(row, 0, index, header)
+            for column, value in enumerate(values, 1):
+                if isinstance(value, str):
+                    # Las columnas de texto también tienen los ceros de las soluciones descartadas.
+                    try:
+                        sheet.write_number(row, column, float(value))
+                    except ValueError:
+                        sheet.write_string(row, column, value)
+                elif not pd.isna(value):
+                    sheet.write_number(row, column, value)
+    workbook.close()
+
+
+def prepare(comparison_db, av_meet=None, **options):
+    """ Returns the prepared_comparison of a comparison database (given the keyword arguments of
+    prepared_comparison), or the database itself if it's already a comparison_index. If comparison_db is the path of
+    a Matcher CSV file, its saved prepared_comparison is used (see load_prepared, and av_meet in load_schools). """
+    if isinstance(comparison_db, comparison_index):
+        return comparison_db
+    if isinstance(comparison_db, str):
+        return load_prepared(comparison_db, av_meet, **options)
+    return prepared_comparison(comparison_db, **options)
+
+
+def match_batch(table, comparison, av_meet=False, cache_size=None, batch=False, metrics=None):
+    """ Matches every school of a table, without printing or writing anything.
+
+    A single school_matcher is used for all the schools, and its answers are written directly in the columns of the
+    results (see match_results.write), so no object is created per school besides its answer.
+
+    Arguments
+    -------------
+    table: The database that contains the schools to be matched (a NumPy 2D-array or a school_table).
+    comparison: The comparison database, prepared or not (see prepare).
+    av_meet, cache_size, batch: The same as do_match.
+    metrics: A match_metrics. If given, it records the time of each stage of the matcher. (Default None)
+
+    Returns
+    ------------
+        The same Pandas DataFrame as do_match.
+
+    """
+    results = match_results(len(table), av_meet)
+    cache = None if cache_size == 0 else match_cache(cache_size)
+    match = match_blocks if batch else match_rows
+    for i, answer in enumerate(match(table, prepare(comparison), 0, len(table), av_meet, cache, metrics)):
+        if answer is not None:
+            results.write(table[i], *answer)
+    return results.to_frame()
+
+
+def match_one_to_one(table, comparison, av_meet=False, threshold=95, exclude=(248814,)):
+    """ Matches every school of a table so that no comparison school is the match of two of them.
+
+    do_match chooses the match of each school on its own, so two schools can take the same comparison school. Here,
+    each school is only linked to the comparison schools that share its information (the av_choice rows of
+    school_matcher.filter_rows: the same blocking by municipality, DANE code and meeting time) and whose name scores
+    more than threshold. The schools that share no information with any comparison school (or have neither
+    municipality nor DANE code), for which filter_rows gives the whole comparison database, are not linked and have
+    no match. The schools and comparison schools linked to each other form small independent blocks (the linked
+    schools of a municipality and of the DANE codes of its schools), and in each block the pairs are chosen with an
+    assignment that maximizes the sum of the scores. Among equal scores, the comparison schools with the same
+    municipality and DANE code are preferred, then the ones with the same municipality, then the ones with the same
+    DANE code (as in solution_picker). The time grows with the number of blocks, not with their product.
+
+    The assignment is solved with SciPy's linear_sum_assignment (SciPy is only needed for this function).
+
+    Arguments
+    -------------
+    table: The database that contains the schools to be matched (a NumPy 2D-array or a school_table).
+    comparison: The comparison database, prepared or not (see prepare).
+    av_meet: The same as do_match.
+    threshold: Only the pairs whose names score more than threshold are linked; the schools left without a pair
+               have no match. (Default 95, the rule of the id_replace do-files)
+    exclude: Match IDs that are never linked. (Default (248814,))
+
+    Returns
+    ------------
+        A Pandas DataFrame with the columns of do_match. The schools without a match have zeros in the Match columns
+        (as the ones whose solutions are all discarded by do_match), and the Similarity of the others is the score
+        of their pair. First is always 0. The number of schools that were not linked because they have no block is
+        printed.
+
+    """
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    index = prepare(comparison)
+    matcher = school_matcher(index, av_meet)
+    blocks = match_cache(256)
+    excluded = np.sort(np.flatnonzero(pd.Series(index.take(index.all_rows)[:, 3]).isin(exclude).to_numpy()))
+    originals, rows, scores, preference = [], [], [], []
+    unblocked = 0
+    for i in range(len(table)):
+        original = table[i]
+        if pd.isna(original[0]):
+            continue
+        matcher.load(original)
+        av_rows = matcher.filter_rows()[0]
+        if len(av_rows) == index.size:
+            # Sin bloque, el colegio se uniría con toda la base y juntaría bloques que son independientes.
+            unblocked += 1
+            continue
+        key = tuple(None if pd.isna(value) else value for value in
+                    (matcher.status, matcher.mun_original, matcher.dane_schoriginal, matcher.jornada))
+        block = blocks.get(key)
+        if block is None:
+            block = index.block(av_rows)
+            blocks.put(key, block)
+
+        kept, kept_scores = index.above(prepare_query(matcher.name_original), block, threshold)
+        for k, score in zip(kept, kept_scores):
+            linked = index.within(index.name_rows[block[0][k]], av_rows)
+            linked = linked[~np.isin(linked, excluded)]
+            if len(linked) == 0:
+                continue
+            schools = index.take(linked)
+            originals.append(np.full(len(linked), i))
+            rows.append(linked)
+            scores.append(np.full(len(linked), score))
+            preference.append(2 * (schools[:, 1] == matcher.mun_original)
+                              + (schools[:, 2] == matcher.dane_schoriginal))
+
+    originals = np.concatenate(originals + [np.empty(0, dtype=np.intp)]).astype(np.intp)
+    rows = np.concatenate(rows + [np.empty(0, dtype=np.intp)]).astype(np.intp)
+    scores = np.concatenate(scores + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+    preference = np.concatenate(preference + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+
+    # Los bloques son las componentes conexas del grafo bipartito (colegios originales y de comparación).
+    n = len(table)
+    graph = coo_matrix((np.ones(len(rows)), (originals, n + rows)), shape=(n + index.size,) * 2)
+    labels = connected_components(graph, directed=False)[1][originals]
+    order = np.argsort(labels, kind="stable")
+    bounds = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1], True]) if len(order) else [0]
+
+    chosen = {}
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        edges = order[start:end]
+        schools, school = np.unique(originals[edges], return_inverse=True)
+        matches, match = np.unique(rows[edges], return_inverse=True)
+        # The preferences only break ties: all of them together are worth less than one point of score.
+        weights = np.zeros((len(schools), len(matches)), dtype=np.int64)
+        weights[school, match] = scores[edges] * 4 * (min(weights.shape) + 1) + preference[edges]
+        if len(schools) == 1:
+            picked = [0], [np.argmax(weights[0])]
+        else:
+            picked = linear_sum_assignment(weights, maximize=True)
+        for s, m in zip(*picked):
+            if weights[s, m] > 0:
+                chosen[schools[s]] = matches[m], weights[s, m] // (4 * (min(weights.shape) + 1))
+
+    print("Schools without a block: {} (not linked).".format(unblocked))
+    results = match_results(len(table), av_meet)
+    empty = np.zeros(matcher.size)
+    for i in range(len(table)):
+        original = table[i]
+        if pd.isna(original[0]):
+            continue
+        if i in chosen:
+            row, score = chosen[i]
+            results.write(original, index.take([row]), score, 0)
+        else:
+            results.write(original, empty, 0, 0)
+    return results.to_frame()
+
+
+def link_years(years, directory=".", doc="crosswalk.csv", threshold=95, exclude=(248814,), workers=1, av_meet=True,
+               exact_names=True, cache_size=None, one_to_one=False):
+    """ Links the schools of several years (Matcher{year}.csv) into a single panel.
+
+    Each year is loaded only once, and its comparison database is prepared only once and saved next to its file to be
+    reused by the next runs (see load_prepared). Then, the schools of each year are matched against the ones of the
+    following year in the list, and the pairs of years are matched at the same time if workers > 1.
+
+    The accepted matches follow the rule used for the id_replace do-files: the similarity must be greater than
+    threshold, the Match ID must not be 0 nor one of the excluded IDs. If several schools of a year are matched to the
+    same school of the next year, the first one is kept (as only the first replace of a do-file takes effect).
 
+    Arguments
+    -------------
+    years: The years, in order (for instance, range(2012, 2017)).
+    directory: The folder with the Matcher{year}.csv files.
+    doc: The name of the crosswalk file. The match table of each pair of years is written next to it, as
+         Matcher-{year}-vs-{next year}.csv.
+    threshold: Minimum similarity (exclusive) of an accepted match. (Default 95)
+    exclude: Match IDs that are never accepted. (Default (248814,))
+    workers: Number of pairs of years matched at the same time, each in its own process. (Default 1)
+             On Windows, the script that calls link_years must be protected by an if __name__ == "__main__": block.
+    av_meet, exact_names, cache_size: The same as do_match.
+    one_to_one: If True, the schools of each pair of years are matched with match_one_to_one (with the same threshold
+                and exclude), so that no school of the next year is taken by two schools. (Default False)
+
+    Returns
+    ------------
+    crosswalk: A Pandas DataFrame with one row per year and ID ("Year", "ID"), and the ID it takes in the panel
+               ("Canonical ID"): the one of the earliest year to which it's linked, through the accepted matches of
+               each pair of consecutive years.
+    matches: A dictionary {(year, next year): match table}.
+
+    """
+    years = list(years)
+    paths = {year: os.path.join(directory, "Matcher{}.csv".format(year)) for year in years}
+    prepared = {year: load_prepared(paths[year], av_meet, exact_names=exact_names) for year in years[1:]}
+    tables = {year: prepared[year].comparisons for year in years[1:]}
+    tables[years[0]] = load_schools(paths[years[0]], av_meet)
+    pairs = list(zip(years[:-1], years[1:]))
+
+    originals = [tables[year] for year, following in pairs]
+    comparisons = [prepared[following] for year, following in pairs]
+    if one_to_one:
+        arguments = match_one_to_one, originals, comparisons, repeat(av_meet), repeat(threshold), repeat(exclude)
+    else:
+        arguments = match_batch, originals, comparisons, repeat(av_meet), repeat(cache_size)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tables_out = list(pool.map(*arguments))
+    else:
+        tables_out = list(map(*arguments))
+    matches = dict(zip(pairs, tables_out))
+
+    folder = os.path.dirname(doc)
+    for (year, following), matching in matches.items():
+        matching.to_csv(os.path.join(folder, "Matcher-{}-vs-{}.csv".format(year, following)))
+
+    ids = pd.unique(tables[years[0]].ids)
+    canonical = pd.Series(ids, index=ids)
+    crosswalk = [pd.DataFrame({"Year": years[0], "ID": canonical.index, "Canonical ID": canonical.values})]
+    for year, following in pairs:
+        matching = matches[year, following]
+        accepted = matching[accepted_matches(matching, threshold, exclude)]
+        accepted = accepted.drop_duplicates("Match ID", keep="first")
+        links = pd.Series(canonical.reindex(accepted["Original ID"]).values, index=accepted["Match ID"].values)
+
+        ids = pd.unique(tables[following].ids)
+        linked = links.reindex(ids)
+        canonical = pd.Series(np.where(linked.notna(), linked, ids), index=ids).astype(np.int64)
+        crosswalk.append(pd.DataFrame({"Year": following, "ID": ids, "Canonical ID": canonical.values}))
+
+    crosswalk = pd.concat(crosswalk, ignore_index=True)
+    crosswalk.to_csv(doc, index=False)
+    return crosswalk, matches
+
+
+def rematch(previous, original_db, comparison_db, old_original_db=None, old_comparison_db=None, doc="matcher.xlsx",
+            av_meet=False, exact_names=True, accept_score=None, cache_size=None):
+    """ Updates the results of do_match after some schools of either database changed (for instance, when a corrected
+    Matcher CSV file arrives), matching again only the schools whose match may have changed.
+
+    The new and old versions of each database are compared with diff_schools. The schools without a match of the
+    previous results that may change are:
+
+        1) The original schools that are new or changed.
+        2) The original schools whose comparison schools with the same information (see school.filter) include a
+           new, changed or removed school, in either version.
+        3) The original schools for which a new, changed or removed school could be the best match of the search
+           among the rest of the comparison database (which spans the whole database, so a change anywhere can
+           affect it): those for which no unchanged school of that search scores more than the best score of the
+           new, changed and removed schools (see prepared_comparison.reaches). The schools whose answer is an exact
+           name (see school_matcher.match), or whose second search is skipped by accept_score, are never among
+           them.
+
+    If the unchanged comparison schools are not in the same order in both versions, every school is matched again (the
+    ties of the searches go to the first school). The rest keep their previous row, so the results are exactly the
+    ones of running do_match again with the new databases.
+
+    Arguments
+    -------------
+    previous: The results of do_match (with deb = deb2 = 0) for the old versions of the databases.
+    original_db, comparison_db: The new versions of the databases (NumPy 2D-arrays, school_tables or the paths of
+                                Matcher CSV files, see do_match).
+    old_original_db, old_comparison_db: The old versions of the databases (the same kinds). If one of them is None,
+                                        that database didn't change. (Default None)
+    doc: The name of the final output, as in do_match.
+    av_meet, exact_names, accept_score, cache_size: The same as do_match. They must be the ones of the previous
+                                                    run.
+
+    Returns
+    ------------
+        The same Pandas DataFrame as do_match with the new databases. It's also written in doc (and as a CSV file).
+
+    """
+    if isinstance(original_db, str):
+        original_db = load_schools(original_db, av_meet)
+    if isinstance(old_original_db, str):
+        old_original_db = load_schools(old_original_db, av_meet)
+    if isinstance(old_comparison_db, comparison_index):
+        old_comparison_db = old_comparison_db.comparisons
+    elif isinstance(old_comparison_db, str):
+        old_comparison_db = load_schools(old_comparison_db, av_meet)
+    comparisons = prepare(comparison_db, av_meet, exact_names=exact_names, accept_score=accept_score)
+
+    if old_original_db is None:
+        old_original_db = original_db
+        originals = np.arange(len(original_db))
+    else:
+        originals = diff_schools(old_original_db, original_db)[0]
+    named = ~pd.isna(old_original_db.take(np.arange(len(old_original_db)), axis=0)[:, 0])
+    if named.sum() != len(previous):
+        raise ValueError("previous must have one row per school with a name of the old original database.")
+    previous_rows = np.cumsum(named) - 1
+
+    if old_comparison_db is None:
+        pairs, in_order = np.arange(comparisons.size), True
+        old_comparison_db = comparisons.comparisons
+    else:
+        pairs, in_order = diff_schools(old_comparison_db, comparisons.comparisons)
+    changed_new = np.flatnonzero(pairs < 0)
+    changed_old = np.setdiff1d(np.arange(len(old_comparison_db)), pairs[pairs >= 0])
+    changes = len(changed_new) + len(changed_old) > 0
+
+    rows = original_db.take(np.arange(len(original_db)), axis=0)
+    schools = [i for i in range(len(rows)) if not pd.isna(rows[i, 0])]
+    again = set(i for i in schools if originals[i] < 0 or not in_order)
+    kept = OrderedDict()
+    if changes:
+        for i in schools:
+            if i not in again:
+                kept.setdefault(match_cache.key(rows[i], av_meet)[1:], []).append(i)
+
+    blocks = searched = 0
+    if changes and in_order and len(kept) > 0:
+        old_index = comparison_index(old_comparison_db)
+        changed = prepared_comparison(np.vstack([old_comparison_db.take(changed_old, axis=0),
+                                                 comparisons.comparisons.take(changed_new, axis=0)]))
+        changed_block = changed.block(changed.all_rows)
+        block = comparisons.block(comparisons.all_rows)
+        in_old = np.zeros(len(old_comparison_db), dtype=bool)
+        in_old[changed_old] = True
+        in_new = np.zeros(comparisons.size, dtype=bool)
+        in_new[changed_new] = True
+        old_matcher = school_matcher(old_index, av_meet)
+        new_matcher = school_matcher(comparisons, av_meet)
+        previous_names = previous["Match School Name"].to_numpy()
+        changed_scores = {}
+
+        def same_search(i, prepared, av_rows, excluded):
+            """ Returns True if the na_choice search can't change the answer of the i-th school. """
+            # The na_choice search doesn't matter if an exact name gives the answer, or if it's skipped.
+            new_matcher.load(rows[i])
+            if new_matcher.exact_match(av_rows) is not None:
+                return True
+            if comparisons.accept_score is not None and new_matcher.na_cutoff(new_matcher.extract(av_rows)[1]) is None:
+                return True
+
+            # Otherwise, the best score among the changed schools (which only depends on the name) must be beaten by
+            # an unchanged school of the search. The previous match is tried first, as it usually does it.
+            if prepared[0] not in changed_scores:
+                changed_scores[prepared[0]] = changed.search(prepared, changed_block, 0)[1]
+            name = previous_names[previous_rows[originals[i]]]
+            name_id = comparisons.processed_ids.get(utils.full_process(name, force_ascii=True)
+                                                    if isinstance(name, str) else None)
+            return comparisons.reaches(prepared, block, changed_scores[prepared[0]] + 1, excluded,
+                                       () if name_id is None else (name_id,))
+
+        for positions in kept.values():
+            old_matcher.load(rows[positions[0]])
+            new_matcher.load(rows[positions[0]])
+            av_old = old_matcher.filter_rows()[0]
+            av_new = new_matcher.filter_rows()[0]
+            if in_old[av_old].any() or in_new[av_new].any():
+                again.update(positions)
+                blocks += len(positions)
+                continue
+
+            excluded = np.union1d(av_new, changed_new)
+            same = {}
+            for i in positions:
+                prepared = prepare_query(rows[i, 0])
+                if prepared[0] not in same:
+                    same[prepared[0]] = same_search(i, prepared, av_new, excluded)
+                if not same[prepared[0]]:
+                    again.add(i)
+                    searched += 1
+    reused = [i for i in schools if i not in again]
+    again = sorted(again)
+
+    if not in_order:
+        print("The unchanged comparison schools are not in the same order: every school is matched again.")
+
+    found = match_batch(original_db.take(again, axis=0), comparisons, av_meet, cache_size, batch=True)
+
+    columns = found.columns
+    reused_rows = previous_rows[originals[np.array(reused, dtype=np.intp)]]
+    results = pd.concat([previous.iloc[reused_rows][columns], found], ignore_index=True)
+    results = results.iloc[np.argsort(np.array(reused + list(again), dtype=np.intp), kind="stable")]
+    results = match_results.integer_ids(results.reset_index(drop=True))
+    print("Matched again: {} of {} schools ({} changed, {} with a changed school of the same information, {} with a "
+          "changed school that could be their best match).".format(len(again), len(results),
+                                                                   len(again) - blocks - searched, blocks, searched))
+
+    writer = output_writer(doc, av_meet)
+    writer.append(results)
+    writer.close()
     return results
 
 
+def diff_schools(old_db, new_db):
+    """ Pairs the schools of two versions of a database.
+
+    The k-th school with an ID in new_db is paired with the k-th school with the same ID in old_db, as long as both
+    rows are the same (missing values are taken as equal).
+
+    Arguments
+    -------------
+    old_db, new_db: The two versions, as NumPy 2D-arrays or school_tables.
+
+    Returns
+    ------------
+    pairs: A NumPy array with, for each school of new_db, the row of old_db it's paired with (-1 if it's new or
+           changed).
+    in_order: True if the paired schools are in the same order in both versions.
+
+    """
+    def contents(db):
+        frame = pd.DataFrame(db.take(np.arange(len(db)), axis=0))
+        frame["occurrence"] = frame.groupby(3, dropna=False).cumcount()
+        return frame
+
+    old_rows = contents(old_db)
+    old_rows["position"] = np.arange(len(old_rows))
+    new_rows = contents(new_db)
+    pairs = new_rows.merge(old_rows, how="left", on=list(new_rows.columns))["position"]
+    pairs = pairs.fillna(-1).to_numpy(dtype=np.intp)
+    paired = pairs[pairs >= 0]
+    return pairs, bool(np.all(paired[1:] > paired[:-1]))
+
+
+def match_rows(original_db, index, first, last, av_meet=False, cache=None, metrics=None, candidates=None):
+    """ Matches the schools original_db[first:last] one by one, with a single school_matcher.
+
+    Arguments
+    -------------
+    original_db: The database that contains the schools to be matched.
+    index: A comparison_index of the comparison database.
+    first, last: The range of rows of original_db to be matched.
+    av_meet: If True, it means that the data provided includes the meeting time.
+    cache: A match_cache. If given, the schools with the same name, codes and meeting time as a school already
+           matched reuse its match. (Default None)
+    metrics: A match_metrics. If given, it records the time of each stage of the matcher. (Default None)
+    candidates: A candidate_table. If given, it keeps the best candidates of each school (index must be a
+                prepared_comparison). (Default None)
+
+    Returns
+    ------------
+        A generator with the answer of school_matcher.match (match, similarity, first) for each school, or None for
+        the schools without a name. match_results.write adds them to the results.
+
+    """
+    matcher = school_matcher(index, av_meet, metrics, candidates)
+    if metrics is not None:
+        start = time.perf_counter()
+    for i in range(first, last):
+        original = original_db[i]
+        if candidates is not None:
+            candidates.start(i)
+        if pd.isna(original[0]):
+            answer = None
+        elif cache is None:
+            answer = matcher.match(original)
+        else:
+            key = cache.key(original, av_meet)
+            answer = cache.get(key)
+            if answer is None:
+                answer = matcher.match(original)
+                cache.put(key, answer)
+                if candidates is not None:
+                    candidates.keep(key)
+            else:
+                if candidates is not None:
+                    candidates.repeat(i, key)
+                if metrics is not None:
+                    metrics.cached += 1
+
+        if metrics is not None:
+            metrics.schools += 1
+            metrics.seconds += time.perf_counter() - start
+        yield answer
+        if metrics is not None:
+            start = time.perf_counter()
+
+
+def match_blocks(original_db, index, first, last, av_meet=False, cache=None, metrics=None, window=4096):
+    """ Matches the schools original_db[first:last] by blocks, giving the same answers as match_rows.
+
+    The schools are taken window at a time. The ones with the same municipality, DANE code and meeting time share the
+    comparison schools of both searches (see school_matcher.filter_rows), so they are matched together (see
+    match_block), and the schools that only differ in their ID are matched once.
+
+    Arguments
+    -------------
+    The same as match_rows, and:
+    window: Number of schools that are grouped at a time. (Default 4096)
+
+    Returns
+    ------------
+        A generator with the same answers as match_rows, in the same order.
+
+    """
+    if not isinstance(index, prepared_comparison):
+        for answer in match_rows(original_db, index, first, last, av_meet, cache, metrics):
+            yield answer
+        return
+
+    matcher = school_matcher(index, av_meet, metrics)
+    for start in range(first, last, window):
+        stop = min(start + window, last)
+        if metrics is not None:
+            clock = time.perf_counter()
+
+        answers = [None] * (stop - start)
+        pending = OrderedDict()
+        for i in range(start, stop):
+            original = original_db[i]
+            if pd.isna(original[0]):
+                continue
+            key = match_cache.key(original, av_meet)
+            if key in pending:
+                pending[key].append(i)
+                if cache is not None:
+                    cache.hits += 1
+                continue
+            answer = None if cache is None else cache.get(key)
+            if answer is None:
+                pending[key] = [i]
+            else:
+                answers[i - start] = answer
+                if metrics is not None:
+                    metrics.cached += 1
+
+        blocks = OrderedDict()
+        for key, positions in pending.items():
+            blocks.setdefault(key[1:], []).append((key, positions))
+
+        for block in blocks.values():
+            originals = [original_db[positions[0]] for key, positions in block]
+            for (key, positions), answer in zip(block, match_block(originals, matcher)):
+                if cache is not None:
+                    cache.put(key, answer)
+                for i in positions:
+                    answers[i - start] = answer
+                if metrics is not None:
+                    metrics.cached += len(positions) - 1
+
+        if metrics is not None:
+            metrics.schools += stop - start
+            metrics.seconds += time.perf_counter() - clock
+        for answer in answers:
+            yield answer
+
+
+def match_block(originals, matcher):
+    """ Matches schools that share their municipality, DANE code and meeting time (see match_blocks).
+
+    The comparison schools are filtered once for all of them, the names of each search are gathered once, and each
+    distinct name (once processed) is searched once (see prepared_comparison.extract_many). Then, the answers are
+    chosen for each school as in school_matcher.match, so each answer is exactly the one of school_matcher.match.
+
+    Arguments
+    -------------
+    originals: A list with the schools (rows of the original database).
+    matcher: A school_matcher whose comparisons are a prepared_comparison.
+
+    Returns
+    ------------
+        A list with the answer of school_matcher.match for each school.
+
+    """
+    index = matcher.comparisons
+    matcher.load(originals[0])
+    av_rows, na_rows = matcher.measure("filter", matcher.filter_rows)
+
+    # The status is the one of the first school, which is the same for all of them.
+    found = [None] * len(originals)
+    searching = []
+    for k, original in enumerate(originals):
+        matcher.load(original)
+        if matcher.metrics is not None:
+            matcher.metrics.count_candidates(matcher.status, len(av_rows), len(na_rows))
+        found[k] = matcher.exact_match(av_rows)
+        if found[k] is None:
+            searching.append(original)
+    if len(searching) == 0:
+        return found
+
+    names = [original[0] for original in searching]
+    av_answers = [(0, 0)] * len(searching)
+    if len(av_rows) > 0:
+        av_answers = matcher.measure("extractOne_av", index.extract_many, names, av_rows)
+
+    cutoffs = [matcher.na_cutoff(answer[1]) for answer in av_answers]
+    asked = [j for j, cutoff in enumerate(cutoffs) if cutoff is not None]
+    na_answers = [(0, 0)] * len(searching)
+    if len(asked) > 0 and len(na_rows) > 0:
+        floors = [max(index.floor, cutoffs[j]) if cutoffs[j] > 0 else None for j in asked]
+        answers = matcher.measure("extractOne_na", index.extract_many, [names[j] for j in asked], na_rows,
+                                  floors)
+        for j, answer in zip(asked, answers):
+            na_answers[j] = answer
+
+    chosen = []
+    for original, av_answer, na_answer in zip(searching, av_answers, na_answers):
+        matcher.load(original)
+        chosen.append(matcher.choose(av_rows, na_rows, av_answer, na_answer))
+    for j, cutoff in enumerate(cutoffs):
+        if cutoff:
+            matcher.count_search("pruned" if na_answers[j][1] == 0 and len(na_rows) > 0 else "cutoff")
+    chosen = iter(chosen)
+    return [answer if answer is not None else next(chosen) for answer in found]
+
+
+class match_cache:
+    """ Remembers the matches already found, so that repeated schools are not matched again.
+
+        The match of a school only depends on its name, municipality, DANE code and meeting time (not on its ID), and
+        the same school appears many times in the original databases (several meeting times, repeated sedes...).
+
+        Parameters:
+        ---------------------
+        maxsize: Maximum number of matches kept (default = None, no limit). When it's reached, the match that was
+                 used the longest time ago is forgotten.
+
+        Attributes:
+        ---------------------
+            matches: An OrderedDict {key: match}, from the least to the most recently used.
+            hits: Number of schools whose match was reused.
+            misses: Number of schools that had to be matched.
+
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.matches = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(original, av_meet=False):
+        """ Returns the tuple (name, municipality, DANE code, meeting time, av_meet) of a school. Missing values are
+            replaced by None, as NaN is never equal to itself. """
+        name, mun, dane = [None if pd.isna(value) else value for value in original[:3]]
+        jornada = None
+        if av_meet and not pd.isna(original[4]):
+            jornada = original[4]
+        return name, mun, dane, jornada, av_meet
+
+    def get(self, key):
+        """ Returns the match of key (the answer of school_matcher.match), or None. """
+        match = self.matches.get(key)
+        if match is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.matches.move_to_end(key)
+        return match
+
+    def put(self, key, match):
+        self.matches[key] = match
+        if self.maxsize is not None and len(self.matches) > self.maxsize:
+            self.matches.popitem(last=False)
+
+
+class candidate_table:
+    """ Keeps the best candidates of both searches of each school, so that the matches can be decided again with
+        other rules without matching again (see redecide).
+
+        The candidates are kept in long format: one row per comparison school, with the school of the original
+        database it's a candidate for ("Original", its row number), the search ("Search": "exact" for the schools with
+        exactly the same name, "av" for the ones that share the school's information and "na" for the rest), the
+        rank of its name in the search ("Rank", 1 for the best name, 0 for the exact names), its row in the
+        comparison database ("Row"), its ID ("Match ID"), the score of its name ("Score"), the Similarity that
+        school_matcher.choose gives when it computes it again against the school's row ("Row Score"), whether it has
+        the same municipality and DANE code as the school ("Same Municipality", "Same DANE") and the information status
+        of the school ("Status"). See school_matcher.match_candidates.
+
+        Parameters:
+        ---------------------
+        k: Number of names kept per search.
+
+        Attributes:
+        ---------------------
+            original: The row of the school being matched (see start).
+            pieces: The candidates added so far, one tuple per name.
+            keys: A dictionary {match_cache key: (first piece, last piece)} with the pieces of each school matched.
+            repeats: The schools that reused the candidates of a key, as tuples (original, first piece, last piece).
+            frames: The tables of other candidate_tables (see merge).
+
+    """
+    searches = ["exact", "av", "na"]
+    statuses = ["Complete", "MunNan", "DaneNaN", "FulNaN"]
+
+    def __init__(self, k):
+        self.k = k
+        self.original = 0
+        self.begin = 0
+        self.pieces = []
+        self.keys = {}
+        self.repeats = []
+        self.frames = []
+
+    def start(self, original):
+        """ Starts the candidates of the school in the row original. """
+        self.original = original
+        self.begin = len(self.pieces)
+
+    def add(self, matcher, search, rank, rows, score):
+        """ Adds the comparison schools in rows, whose name has the given rank and score, to the school loaded in the
+            matcher (a school_matcher). """
+        if len(rows) == 0:
+            return
+        schools = matcher.comparisons.take(rows)
+        row_scores = [fuzz.token_set_ratio(matcher.name_original, schools[j:j + 1]) for j in range(len(rows))]
+        self.pieces.append((self.original, search, rank, rows, schools[:, 3], score,
+                            schools[:, 1] == matcher.mun_original, schools[:, 2] == matcher.dane_schoriginal,
+                            matcher.status, row_scores))
+
+    def keep(self, key):
+        """ Remembers the candidates of the current school under its match_cache key. """
+        self.keys[key] = (self.begin, len(self.pieces))
+
+    def repeat(self, original, key):
+        """ The school in the row original has the candidates of the school matched with the same key. """
+        self.repeats.append((original,) + self.keys[key])
+
+    def merge(self, frame, offset=0):
+        """ Adds the table of another candidate_table, whose originals start at offset. """
+        frame = frame.copy()
+        frame["Original"] += offset
+        self.frames.append(frame)
+
+    def to_frame(self):
+        """ Returns all the candidates as a Pandas DataFrame, sorted by Original (and, for each school, in the order
+            they were added). """
+        pieces = list(self.pieces)
+        for original, begin, end in self.repeats:
+            pieces += [(original,) + piece[1:] for piece in self.pieces[begin:end]]
+        lengths = np.array([len(piece[3]) for piece in pieces], dtype=np.int64)
+
+        def column(k, dtype):
+            return np.repeat(np.array([piece[k] for piece in pieces], dtype=dtype), lengths)
+
+        def joined(k, dtype):
+            return np.concatenate([np.asarray(piece[k], dtype=dtype) for piece in pieces] + [np.empty(0, dtype)])
+
+        frame = pd.DataFrame({"Original": column(0, np.int64),
+                              "Search": pd.Categorical(column(1, object), categories=self.searches),
+                              "Rank": column(2, np.int16), "Row": joined(3, np.int32),
+                              "Match ID": joined(4, np.float64), "Score": column(5, np.int16),
+                              "Row Score": joined(9, np.int16),
+                              "Same Municipality": joined(6, bool), "Same DANE": joined(7, bool),
+                              "Status": pd.Categorical(column(8, object), categories=self.statuses)})
+        frame = pd.concat([frame] + self.frames, ignore_index=True)
+        return frame.iloc[np.argsort(frame["Original"].to_numpy(), kind="stable")].reset_index(drop=True)
+
+
+def redecide(candidates, threshold=95, exclude=(248814,), exact_names=True, accept_score=None):
+    """ Decides again the match of each school from its candidates (see candidate_table), without matching again.
+
+    The candidates whose Match ID is excluded are left out, and then the rules of school_matcher.match are applied
+    to the rest: the exact names are taken first (if exact_names), then the best name left of each search, and a
+    single solution is preferred to several; otherwise, the best score wins. The solutions are filtered as in
+    solution_picker and the first one is taken, as in multiple. So, if the best candidate of a school is excluded,
+    the next one can be chosen.
+
+    When both searches give several solutions or one each, the Similarity is the one computed again against the
+    chosen school's row (the "Row Score" of the candidate, as in choose), and otherwise the score of the chosen name.
+    So, with nothing excluded, and the exact_names and accept_score of the run, the Match ID, Similarity, First and
+    Accepted of each school are the ones of do_match (see redecide_report), except the Similarity of the schools
+    whose solutions are all discarded in that case, which is 0 (they are never accepted).
+
+    Arguments
+    -------------
+    candidates: The table of a candidate_table (the file doc without its extension plus "_candidates.pkl", written
+                by do_match).
+    threshold, exclude: The acceptance rule (see accepted_matches). (Default 95 and (248814,))
+    exact_names, accept_score: The same as do_match.
+
+    Returns
+    ------------
+        A Pandas DataFrame with one row per school with candidates: its row ("Original"), the search of its match
+        ("Search", None if every solution was discarded), the row and ID of the match ("Match Row" and "Match ID", -1
+        and 0 if there is none), "Similarity", "First" and whether the match is accepted ("Accepted").
+
+    """
+    table = candidates[~candidates["Match ID"].isin(exclude)]
+    originals = table["Original"].to_numpy()
+    search = table["Search"].cat.codes.to_numpy()
+    rank = table["Rank"].to_numpy()
+    score = table["Score"].to_numpy()
+    row_score = table["Row Score"].to_numpy()
+    same_mun = table["Same Municipality"].to_numpy()
+    same_dane = table["Same DANE"].to_numpy()
+    status = table["Status"].to_numpy()
+
+    def picked(start, end):
+        """ solution_picker and multiple for the solutions in start:end: (position, first), with position -1 if
+            every solution is discarded. """
+        if end - start == 1:
+            return start, 0
+        if end == start:
+            return -1, 0
+        if status[start] == "Complete":
+            tests = [same_mun & same_dane, same_mun, same_dane]
+        elif status[start] == "DaneNaN":
+            tests = [same_mun]
+        elif status[start] == "MunNaN":
+            tests = [same_dane]
+        else:
+            tests = []
+        for test in tests:
+            kept = np.flatnonzero(test[start:end])
+            if len(kept) > 0:
+                return start + kept[0], int(len(kept) > 1)
+        return -1, 0
+
+    bounds = np.flatnonzero(np.r_[True, originals[1:] != originals[:-1], True]) if len(table) > 0 else [0]
+    decided = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        # Los candidatos de cada búsqueda vienen ordenados por rango: el mejor nombre es el primer grupo.
+        groups = {}
+        position = start
+        while position < end:
+            stop = position + 1
+            while stop < end and search[stop] == search[position] and rank[stop] == rank[position]:
+                stop += 1
+            groups.setdefault(search[position], (position, stop))
+            position = stop
+
+        if exact_names and 0 in groups:
+            position, first = picked(*groups[0])
+            if position >= 0:
+                decided.append((originals[start], 0, position, 100, first))
+                continue
+
+        av, na = groups.get(1, (start, start)), groups.get(2, (start, start))
+        av_score = score[av[0]] if av[1] > av[0] else 0
+        na_score = score[na[0]] if na[1] > na[0] else 0
+        if accept_score is not None and (av_score >= accept_score or na_score < av_score):
+            na, na_score = (start, start), 0
+        n_av, n_na = av[1] - av[0], na[1] - na[0]
+        if n_av == 1 and n_na != 1:
+            chosen = 1, av, av_score
+        elif n_na == 1 and n_av != 1:
+            chosen = 2, na, na_score
+        elif av_score >= na_score:
+            chosen = 1, av, None
+        else:
+            chosen = 2, na, None
+        position, first = picked(*chosen[1])
+        similarity = chosen[2]
+        if similarity is None:
+            similarity = row_score[position] if position >= 0 else 0
+        decided.append((originals[start], chosen[0], position, similarity, first))
+
+    decided = pd.DataFrame(decided, columns=["Original", "Search", "Match Row", "Similarity", "First"])
+    rows = decided["Match Row"].to_numpy()
+    found = rows >= 0
+    ids = np.zeros(len(decided))
+    ids[found] = table["Match ID"].to_numpy()[rows[found]]
+    decided["Search"] = pd.Categorical.from_codes(np.where(found, decided["Search"], -1), candidate_table.searches)
+    decided["Match Row"] = np.where(found, table["Row"].to_numpy()[np.maximum(rows, 0)], -1)
+    decided.insert(3, "Match ID", ids)
+    decided["Accepted"] = accepted_matches(decided, threshold, exclude)
+    return decided
+
+
+def redecide_report(info, candidates, thresholds=(95, 90, 80), exact_names=True, accept_score=None):
+    """ Checks that redecide gives the decisions of do_match.
+
+    For each threshold, the matches accepted by redecide (with nothing excluded) are compared with the ones that
+    accepted_matches gives for the results of the run that kept the candidates.
+
+    Arguments
+    -------------
+    info: The results of do_match (with deb = deb2 = 0 and candidates > 0).
+    candidates: The candidates kept by that run (see redecide).
+    thresholds: The thresholds to compare.
+    exact_names, accept_score: The ones of the run.
+
+    Returns
+    ------------
+        A Pandas DataFrame with one row per threshold: the number of schools, the matches accepted by do_match and
+        by redecide, and the schools in which they disagree ("Disagreements", which must be 0).
+
+    """
+    rows = []
+    for threshold in thresholds:
+        decided = redecide(candidates, threshold, (), exact_names, accept_score)
+        if len(decided) != len(info):
+            raise ValueError("The candidates must be the ones of the whole run that gave info.")
+        accepted = accepted_matches(info, threshold).to_numpy()
+        rows.append({"Threshold": threshold, "Schools": len(info), "do_match": accepted.sum(),
+                     "redecide": decided["Accepted"].sum(),
+                     "Disagreements": (accepted != decided["Accepted"].to_numpy()).sum()})
+    return pd.DataFrame(rows)
+
+
+class match_metrics:
+    """ Records where the time of the matcher goes.
+
+        Each school_matcher.match call adds the time and number of calls of its stages (filter, exact_names, the
+        extractOne searches among the schools that share its information, extractOne_av, and among the rest,
+        extractOne_na, solution_picker and multiple), and the number of candidates it compared against (av_choice
+        and na_choice), counted in bins by information status.
+
+        Attributes:
+        ---------------------
+            stages: A dictionary {stage: [calls, seconds]}.
+            candidates: A dictionary {status: array}, where the first row of the array counts the schools by size of
+                        av_choice, and the second by size of na_choice, in the bins of BINS.
+            schools: Number of schools matched (including the ones without a name and the ones from the cache).
+            cached: Number of schools whose match was taken from the match_cache.
+            seconds: Time spent matching the schools.
+            searches: When the prepared_comparison has an accept_score, a dictionary with the number of na_choice
+                      searches that were skipped ("skipped"), that only looked for names scoring at least the
+                      av_choice score and found one ("cutoff"), and that found none ("pruned").
+
+    """
+    BINS = np.array([0, 1, 10, 100, 1000, 10000, 100000])
+    LABELS = ["0", "1-9", "10-99", "100-999", "1000-9999", "10000-99999", "100000+"]
+
+    def __init__(self):
+        self.stages = {}
+        self.candidates = {}
+        self.schools = 0
+        self.cached = 0
+        self.seconds = 0.0
+        self.searches = {}
+
+    def measure(self, stage, function, *args):
+        """ Calls function(*args) and adds its time to stage. """
+        start = time.perf_counter()
+        value = function(*args)
+        measured = self.stages.setdefault(stage, [0, 0.0])
+        measured[0] += 1
+        measured[1] += time.perf_counter() - start
+        return value
+
+    def count_candidates(self, status, n_av, n_na):
+        counts = self.candidates.get(status)
+        if counts is None:
+            counts = self.candidates[status] = np.zeros((2, len(self.BINS)), dtype=np.int64)
+        counts[0, np.searchsorted(self.BINS, n_av, side="right") - 1] += 1
+        counts[1, np.searchsorted(self.BINS, n_na, side="right") - 1] += 1
+
+    def merge(self, other):
+        """ Adds the metrics of other (for instance, the ones of a chunk matched in another process). """
+        for stage, (calls, seconds) in other.stages.items():
+            measured = self.stages.setdefault(stage, [0, 0.0])
+            measured[0] += calls
+            measured[1] += seconds
+        for status, counts in other.candidates.items():
+            if status in self.candidates:
+                self.candidates[status] = self.candidates[status] + counts
+            else:
+                self.candidates[status] = counts.copy()
+        self.schools += other.schools
+        self.cached += other.cached
+        self.seconds += other.seconds
+        for outcome, count in other.searches.items():
+            self.searches[outcome] = self.searches.get(outcome, 0) + count
+
+    def summary(self):
+        """ Returns the metrics as a dictionary that can be written as JSON. """
+        return {"schools": self.schools,
+                "cached": self.cached,
+                "seconds": self.seconds,
+                "schools_per_sec": self.schools / self.seconds if self.seconds > 0 else None,
+                "na_choice_searches": self.searches,
+                "stages": {stage: {"calls": calls, "seconds": seconds}
+                           for stage, (calls, seconds) in self.stages.items()},
+                "candidates": {status: {"av_choice": dict(zip(self.LABELS, counts[0].tolist())),
+                                        "na_choice": dict(zip(self.LABELS, counts[1].tolist()))}
+                               for status, counts in self.candidates.items()}}
+
+
+class progress_line:
+    """ Prints the progress of a run in a single line, at most once every interval seconds.
+
+        Parameters:
+        ---------------------
+        total: Number of schools of the run.
+        interval: Minimum time between two updates, in seconds (default = 1).
+        stream: Where the line is written (default = sys.stdout).
+
+    """
+    def __init__(self, total, interval=1.0, stream=None):
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.start = self.shown = time.perf_counter()
+        self.done = 0
+
+    def update(self, done):
+        self.done = done
+        now = time.perf_counter()
+        if now - self.shown >= self.interval:
+            self.shown = now
+            self.show(now)
+
+    def show(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.done) / rate if rate > 0 else 0
+        self.stream.write("\r{} of {} schools  {:.1f} schools/sec  ETA {:d}:{:02d}:{:02d} ".format(
+            self.done, self.total, rate, int(eta // 3600), int(eta % 3600 // 60), int(eta % 60)))
+        self.stream.flush()
+
+    def close(self):
+        self.show(time.perf_counter())
+        self.stream.write("\n")
+
+
+# Each process of the pool keeps its own comparison index (and match_cache), built once by _start_worker.
+_worker = {}
+
+
+def _start_worker(comparison_db, options, cache_size, av_meet):
+    _worker["index"] = prepare(comparison_db, av_meet, **options)
+    _worker["cache"] = None if cache_size == 0 else match_cache(cache_size)
+
+
+def _match_chunk(chunk, av_meet, metrics, batch, k=0):
+    cache = _worker["cache"]
+    hits, misses = (0, 0) if cache is None else (cache.hits, cache.misses)
+    metrics = match_metrics() if metrics else None
+    if k:
+        # Cada bloque guarda sus propios candidatos: la caché del proceso no sirve para repetirlos.
+        candidates = candidate_table(k)
+        answers = list(match_rows(chunk, _worker["index"], 0, len(chunk), av_meet, None, metrics, candidates))
+        candidates = candidates.to_frame()
+    else:
+        match = match_blocks if batch else match_rows
+        answers = list(match(chunk, _worker["index"], 0, len(chunk), av_meet, cache, metrics))
+        candidates = None
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return answers, hits, misses, metrics, candidates
+
+
+def parallel_matches(original_db, comparison_db, first, last, av_meet=False, workers=2, options=None, cache=None,
+                     metrics=None, batch=False, candidates=None):
+    """ Matches the schools original_db[first:last] in a pool of processes.
+
+    The range is divided in chunks (several per process, so that they stay busy). The comparison database is sent to
+    each process only once, when it starts, and only the chunks travel with the tasks. If it's the path of a Matcher
+    CSV file, each process maps its saved prepared_comparison (see load_prepared).
+
+    Arguments
+    -------------
+    The same as match_rows, with the comparison database instead of its index, and:
+    workers: Number of processes.
+    options: A dictionary with the keyword arguments for prepared_comparison.
+    cache: A match_cache. Each process keeps its own cache with the same maxsize, and their hits and misses are
+           added to this one.
+    metrics: A match_metrics. Each chunk is measured in its process, and its metrics are added to this one (so the
+             times are the sum over the processes, not the elapsed time).
+    batch: If True, each chunk is matched with match_blocks. (Default False)
+    candidates: A candidate_table. If given, each chunk keeps its candidates (with match_rows and no cache), and
+                their tables are merged into this one.
+
+    Returns
+    ------------
+        A generator with the same answers as match_rows, in the same order.
+
+    """
+    size = max(1, -(-(last - first) // (workers * 8)))
+    starts = range(first, last, size)
+    chunks = [original_db[start:min(start + size, last)] for start in starts]
+    cache_size = 0 if cache is None else cache.maxsize
+    k = 0 if candidates is None else candidates.k
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker,
+                             initargs=(comparison_db, options or {}, cache_size, av_meet)) as pool:
+        measure = repeat(metrics is not None)
+        results = pool.map(_match_chunk, chunks, repeat(av_meet), measure, repeat(batch), repeat(k))
+        for start, (answers, hits, misses, measured, kept) in zip(starts, results):
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            if metrics is not None:
+                metrics.merge(measured)
+            if candidates is not None:
+                candidates.merge(kept, start)
+            for answer in answers:
+                yield answer
+
+
+class match_results:
+    """ Accumulates the answers of school_matcher.match (or the rows returned by school.matcher).
+
+        The rows are written in preallocated, typed columns (one NumPy array per output column) instead of stacking
+        them in a single object array, so adding a school does not copy the results found so far.
+
+        Parameters:
+        ---------------------
+        capacity: Number of schools that are expected (the columns grow if more are added).
+        av_meet: if True, the rows include the meeting time (default = False).
+
+        Attributes:
+        ---------------------
+            columns: Names of the output columns, in order.
+            data: A dictionary {column name: NumPy array}.
+            n: Number of rows added so far.
+
+    """
+    columns_meet = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
+                    "Original Jornada", "Match School Name", "Match Municipality", "Match DANE",
+                    "Match ID", "Match Jornada", "Similarity", "First"]
+
+    columns_no_meet = ["Original School Name", "Original Municipality", "Original DANE", "Original ID",
+                       "Match School Name", "Match Municipality", "Match DANE", "Match ID",
+                       "Similarity", "First"]
+
+    dtypes = {"Original School Name": object, "Original Municipality": np.float64, "Original DANE": np.float64,
+              "Original ID": np.float64, "Original Jornada": object, "Match School Name": object,
+              "Match Municipality": np.float64, "Match DANE": np.float64, "Match ID": np.float64,
+              "Match Jornada": object, "Similarity": np.int64, "First": np.int64}
+
+    def __init__(self, capacity, av_meet=False):
+        self.av_meet = av_meet
+        self.columns = self.columns_meet if av_meet else self.columns_no_meet
+        self.data = {column: np.empty(max(capacity, 1), dtype=self.dtypes[column]) for column in self.columns}
+        self.n = 0
+
+    def add(self, row):
+        """ Writes one row (as returned by school.matcher) at the end of the columns. """
+        self.grow()
+        for column, value in zip(self.columns, np.ravel(row)):
+            self.data[column][self.n] = value
+        self.n += 1
+
+    def write(self, original, match, similarity, first):
+        """ Writes the row of a school (original) and the answer of school_matcher.match for it at the end of the
+            columns, without building the row. """
+        self.grow()
+        data, n = self.data, self.n
+        for column, value in zip(self.columns, original):
+            data[column][n] = value
+        for column, value in zip(self.columns[len(original):], match[0]):
+            data[column][n] = value
+        data["Similarity"][n] = similarity
+        data["First"][n] = first
+        self.n += 1
+
+    def grow(self):
+        """ Doubles the length of the columns if they are full. """
+        if self.n == len(self.data[self.columns[0]]):
+            for column in self.columns:
+                self.data[column] = np.concatenate([self.data[column], np.empty_like(self.data[column])])
+
+    def to_frame(self, start=0):
+        """ Returns the rows added so far (from start on) as a Pandas DataFrame with the output columns.
+
+            The ID columns are stored as floats (so they can hold missing values), but they are returned as integers
+            whenever none is missing.
+        """
+        frame = pd.DataFrame({column: self.data[column][start:self.n] for column in self.columns},
+                             columns=self.columns)
+        return self.integer_ids(frame)
+
+    @staticmethod
+    def integer_ids(frame):
+        """ Converts the ID columns of a frame of results to integers if none is missing (see to_frame). """
+        for column in ["Original ID", "Match ID"]:
+            if not frame[column].isna().any():
+                frame[column] = frame[column].astype(np.int64)
+        return frame
+
+
 def stata_codes(info, doc="stata_codes.xlsx"):
     """ This function creates the code needed in Stata to impute to each school in the Original Database the ID codes
     in the comparison database.
@@ -427,24 +2988,99 @@ def stata_codes(info, doc="stata_codes.xlsx"):
         In addition, it creates a Do-File and an Excel Spreadsheet with it.
 
     """
-    length = info.shape[0]
-    database = info.ix
-    txt = "replace newID = "
-    txt2 = " if ID == "
-    codes = np.array(["gen newID = ."])
+    codes = ["gen newID = ."]
 
     do_file = open(doc[:-4]+"do", "w")
     do_file.write(codes[0])
 
-    for i in range(1, length):
-        if database[i, "Match ID"] == 0 or pd.isna(database[i, "Match ID"]):
-            pass
-        else:
-            line = txt + str(database[i, "Match ID"]) + txt2 + str(database[i, "Original ID"])
-            do_file.write("\n"+line)
-            codes = np.vstack([codes, line])
+    for block in replace_lines(info, value="Match ID", key="Original ID", target="newID", variable="ID"):
+        do_file.write("\n"+block)
+        codes.extend(block.split("\n"))
 
     do_file.close()
     codes = pd.DataFrame(codes)
     codes.to_excel(doc)
     return codes
+
+
+def accepted_matches(info, threshold=None, exclude=(), changed_only=False):
+    """ Returns a boolean Series that tells which rows of a match table are accepted.
+
+    Arguments
+    -------------
+    info: A Pandas Data Frame with the output of do_match.
+    threshold: If given, the similarity must be greater than threshold.
+    exclude: Match IDs that are never accepted.
+    changed_only: If True, the rows whose Match ID is the same as the Original ID are not accepted.
+
+    A row is never accepted if its Match ID is 0 or missing.
+
+    """
+    accepted = info["Match ID"].notna() & (info["Match ID"] != 0)
+    if threshold is not None:
+        accepted &= info["Similarity"] > threshold
+    if len(exclude) > 0:
+        accepted &= ~info["Match ID"].isin(exclude)
+    if changed_only:
+        accepted &= info["Original ID"] != info["Match ID"]
+    return accepted
+
+
+def replace_lines(info, value="Original ID", key="Match ID", target="id_sede", variable="id_sede", condition="",
+                  threshold=None, exclude=(), changed_only=False, block=10000):
+    """ Generates the replace lines of a Stata do-file from a match table.
+
+    Each accepted row (see accepted_matches) gives the line
+        replace <target> = <value> if <variable> == <key><condition>
+    The lines are built with vectorized string operations, block rows at a time, so that they can be written to
+    disk as they are generated.
+
+    Arguments
+    -------------
+    info: A Pandas Data Frame with the output of do_match.
+    value, key: The columns of info with the new value and with the ID to be replaced.
+    target, variable: The names of the Stata variables.
+    condition: Text added at the end of every line (for instance, " & periodo == 2013").
+    threshold, exclude, changed_only: See accepted_matches.
+    block: Number of rows of info processed at a time.
+
+    Returns
+    ------------
+        A generator with one string per block, with its lines separated by "\n" (blocks without lines are
+        skipped).
+
+    """
+    for start in range(0, len(info), block):
+        rows = info.iloc[start:start + block]
+        rows = rows[accepted_matches(rows, threshold, exclude, changed_only)]
+        if len(rows) > 0:
+            lines = ("replace " + target + " = " + rows[value].astype(str) + " if " + variable + " == " +
+                     rows[key].astype(str) + condition)
+            yield "\n".join(lines)
+
+
+def id_crosswalk(info, threshold=None, exclude=(), changed_only=False, period=None):
+    """ Returns the accepted matches of a match table as a crosswalk that can be merged in Stata.
+
+    Instead of running one replace per school, the crosswalk can be merged (m:1) on id_sede (and periodo), and
+    new_id_sede used where it's not missing. As with the do-files, where only the first replace of an ID takes
+    effect, only the first accepted match of each Match ID is kept.
+
+    Arguments
+    -------------
+    info: A Pandas Data Frame with the output of do_match.
+    threshold, exclude, changed_only: See accepted_matches.
+    period: If given, a column periodo with this value is added.
+
+    Returns
+    ------------
+        A Pandas Data Frame with the columns id_sede (the Match ID) and new_id_sede (the Original ID), and periodo
+        if period is given.
+
+    """
+    accepted = info[accepted_matches(info, threshold, exclude, changed_only)]
+    crosswalk = pd.DataFrame({"id_sede": accepted["Match ID"].values, "new_id_sede": accepted["Original ID"].values})
+    crosswalk = crosswalk.drop_duplicates("id_sede", keep="first")
+    if period is not None:
+        crosswalk.insert(0, "periodo", period)
+    return crosswalk
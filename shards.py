@@ -0,0 +1,332 @@
+# Matcher shards
+#
+# Runs do_match over several machines that only share a folder (no scheduler). The original database is divided in
+# shards that keep each department together (the first digits of muni_id), so the schools that share their blocking
+# keys are always matched on the same machine:
+#
+#   python shards.py plan Matcher11.csv Base359_matcher.csv --folder shards --shards 8
+#   python shards.py run shards --next          (on each machine, as many times as wanted)
+#   python shards.py run shards --shard 3       (runs, or resumes, one shard)
+#   python shards.py merge shards --doc Matcher.csv --do-file id_replace.do
+#
+# "run --next" claims the shards that nobody has started (with a lock file in the folder), so the same command can be
+# started on every machine. A shard that was interrupted resumes from its checkpoints (see checkpoint_store) when it
+# is run again with --shard. "merge" checks that every shard is complete and assembles the match table (in the order
+# of the original database, the same as do_match over the whole database) and the do-file.
+#
+#   python shards.py local shards --processes 4
+#
+# starts "run --next" in several processes of this machine, and then merges the shards.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from matcher_saber import (MATCHER_VERSION, MISSING, accepted_matches, csv_to_excel, do_match, file_hash,
+                           load_prepared, load_schools, match_one_to_one, replace_lines)
+
+MODES = ["greedy", "one-to-one"]
+
+
+def departments(table):
+    """ The department of each school of a school_table: the first digits of its municipality (muni_id // 1000) or,
+    if it's missing, of the municipality in its DANE code. The schools without either are in department -1. """
+    dane_mun = table.dane // 10 ** 6 % 10 ** 5
+    mun = np.where(table.mun != MISSING, table.mun, np.where(table.dane != MISSING, dane_mun, -1000))
+    return mun // 1000
+
+
+def plan(original, comparison, folder, shards, av_meet=None, mode="greedy", options=None):
+    """ Divides the original database in shards and writes their manifests.
+
+    The departments are given to the shards from the largest down, each to the shard with the fewest schools so far,
+    so the shards have about the same number of schools. The comparison database is prepared (and saved next to its
+    file, see load_prepared), so that the runs only map it.
+
+    Arguments
+    -------------
+    original, comparison: The paths of the Matcher CSV files.
+    folder: The folder of the shards (shared by every machine).
+    shards: Number of shards.
+    av_meet: The same as load_schools.
+    mode: "greedy" (do_match) or "one-to-one" (match_one_to_one). In one-to-one mode, the assignment is done in each
+          shard. The blocks of match_one_to_one stay in a department, unless a school's municipality and DANE code
+          are in different departments: then two shards may take the same comparison school (merge counts them).
+    options: A dictionary with the keyword arguments of do_match (or match_one_to_one) for every shard.
+
+    Returns
+    ------------
+        The manifest of the plan (plan.json): the files (relative to folder, so it can be mounted anywhere) and
+        their SHA-256, the options and the shards, each with its departments and number of schools. The rows of
+        each shard are in shard-<k>.npy, and its manifest in shard-<k>.json.
+
+    """
+    os.makedirs(folder, exist_ok=True)
+    if av_meet is None:
+        av_meet = len(pd.read_csv(original, nrows=0).columns) > 4
+    table = load_schools(original, av_meet)
+    load_prepared(comparison, av_meet)
+
+    department = departments(table)
+    codes, sizes = np.unique(department, return_counts=True)
+    loads = np.zeros(shards, dtype=np.int64)
+    members = [[] for _ in range(shards)]
+    for k in np.argsort(-sizes, kind="stable"):
+        lightest = int(np.argmin(loads))
+        loads[lightest] += sizes[k]
+        members[lightest].append(int(codes[k]))
+
+    manifest = {"version": MATCHER_VERSION, "mode": mode, "av_meet": av_meet, "options": options or {},
+                "original": os.path.relpath(original, folder), "original_sha256": file_hash(original),
+                "comparison": os.path.relpath(comparison, folder), "comparison_sha256": file_hash(comparison),
+                "schools": len(table), "shards": []}
+    for shard in range(shards):
+        rows = np.flatnonzero(np.isin(department, members[shard]))
+        np.save(os.path.join(folder, "shard-{}.npy".format(shard)), rows)
+        entry = {"shard": shard, "rows": "shard-{}.npy".format(shard), "schools": len(rows),
+                 "departments": sorted(members[shard])}
+        write_json(os.path.join(folder, "shard-{}.json".format(shard)), entry)
+        manifest["shards"].append(entry)
+    write_json(os.path.join(folder, "plan.json"), manifest)
+    return manifest
+
+
+def read_plan(folder):
+    """ Reads plan.json and checks that the files of the databases didn't change since the plan was made. """
+    with open(os.path.join(folder, "plan.json")) as file:
+        manifest = json.load(file)
+    for name in ["original", "comparison"]:
+        path = os.path.join(folder, manifest[name])
+        if file_hash(path) != manifest[name + "_sha256"]:
+            raise ValueError("{} changed since the plan was made. Make a new plan.".format(path))
+    return manifest
+
+
+def run(folder, shard, workers=1, manifest=None):
+    """ Matches the schools of one shard, and marks it as done.
+
+    The shard is claimed (see claim), even if another run already had it. The results are written to
+    shard-<k>.pkl, and then shard-<k>.done.json records the machine, the time and the number of rows. If the run is
+    interrupted, running the shard again resumes it from its checkpoints (shard-<k>_checkpoints, see do_match).
+    """
+    manifest = manifest or read_plan(folder)
+    claim(folder, shard)
+    original = os.path.join(folder, manifest["original"])
+    comparison = os.path.join(folder, manifest["comparison"])
+    av_meet = manifest["av_meet"]
+    rows = np.load(os.path.join(folder, manifest["shards"][shard]["rows"]))
+    table = load_schools(original, av_meet).take(rows)
+    doc = os.path.join(folder, "shard-{}.xlsx".format(shard))
+
+    start = time.perf_counter()
+    if manifest["mode"] == "one-to-one":
+        results = match_one_to_one(table, load_prepared(comparison, av_meet), av_meet, **manifest["options"])
+    else:
+        options = dict({"freq": 1000, "progress": False}, **manifest["options"])
+        results = do_match(table, comparison, doc=doc, partial=True, resume=True, av_meet=av_meet, excel=False,
+                           workers=workers, **options)
+    seconds = time.perf_counter() - start
+
+    path = os.path.join(folder, "shard-{}.pkl".format(shard))
+    results.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    write_json(os.path.join(folder, "shard-{}.done.json".format(shard)),
+               {"shard": shard, "rows": len(results), "host": platform.node(), "seconds": seconds,
+                "finished": time.strftime("%Y-%m-%d %H:%M:%S")})
+    return results
+
+
+def claim(folder, shard):
+    """ Takes the lock of a shard (shard-<k>.lock). Returns False if another run already has it. """
+    try:
+        descriptor = os.open(os.path.join(folder, "shard-{}.lock".format(shard)), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(descriptor, "w") as file:
+        json.dump({"host": platform.node(), "pid": os.getpid(), "started": time.strftime("%Y-%m-%d %H:%M:%S")}, file)
+    return True
+
+
+def run_next(folder, workers=1):
+    """ Runs, one after the other, every shard that no other run has claimed. Returns the shards it ran. """
+    manifest = read_plan(folder)
+    done = []
+    for entry in manifest["shards"]:
+        finished = os.path.exists(os.path.join(folder, "shard-{}.done.json".format(entry["shard"])))
+        if not finished and claim(folder, entry["shard"]):
+            print("Shard {} ({} schools)".format(entry["shard"], entry["schools"]))
+            run(folder, entry["shard"], workers, manifest)
+            done.append(entry["shard"])
+    return done
+
+
+def status(folder, manifest=None):
+    """ The state of each shard: "done", "running" (claimed but not done) or "pending". """
+    manifest = manifest or read_plan(folder)
+    states = {}
+    for entry in manifest["shards"]:
+        shard = entry["shard"]
+        if os.path.exists(os.path.join(folder, "shard-{}.done.json".format(shard))):
+            states[shard] = "done"
+        elif os.path.exists(os.path.join(folder, "shard-{}.lock".format(shard))):
+            states[shard] = "running"
+        else:
+            states[shard] = "pending"
+    return states
+
+
+def merge(folder, doc=None, do_file=None, excel=False, threshold=95, exclude=(248814,), changed_only=False,
+          condition=""):
+    """ Checks that every shard is complete and assembles the match table.
+
+    The rows of the shards must cover the original database exactly once, and each shard must have as many results
+    as schools with a name. The results are put back in the order of the original database, so the table is the
+    same as the one of do_match over the whole database.
+
+    Arguments
+    -------------
+    folder: The folder of the shards.
+    doc: If given, the CSV file where the table is written (and, if excel, the Excel Spreadsheet with the same name).
+    do_file: If given, the do-file with the replace lines of the accepted matches (see replace_lines).
+    threshold, exclude, changed_only, condition: See replace_lines.
+
+    Returns
+    ------------
+        The match table, as a Pandas DataFrame.
+
+    """
+    manifest = read_plan(folder)
+    states = status(folder, manifest)
+    missing = [shard for shard, state in states.items() if state != "done"]
+    if missing:
+        raise ValueError("The shards {} are not done ({}).".format(
+            missing, ", ".join("{}: {}".format(shard, states[shard]) for shard in missing)))
+
+    table = load_schools(os.path.join(folder, manifest["original"]), manifest["av_meet"])
+    named = ~pd.isna(table.names)
+    covered = np.zeros(manifest["schools"], dtype=np.int64)
+    frames = []
+    for entry in manifest["shards"]:
+        rows = np.load(os.path.join(folder, entry["rows"]))
+        covered[rows] += 1
+        results = pd.read_pickle(os.path.join(folder, "shard-{}.pkl".format(entry["shard"])))
+        rows = rows[named[rows]]
+        if len(results) != len(rows):
+            raise ValueError("Shard {} has {} results for {} schools.".format(entry["shard"], len(results), len(rows)))
+        frames.append(results.set_index(rows))
+    if not (covered == 1).all():
+        raise ValueError("The shards don't cover every school of the original database exactly once.")
+
+    matching = pd.concat(frames).sort_index().reset_index(drop=True)
+    for column in ["Original ID", "Match ID"]:
+        if not matching[column].isna().any():
+            matching[column] = matching[column].astype(np.int64)
+
+    accepted = matching[accepted_matches(matching, threshold, exclude, changed_only)]
+    print("{} schools, {} accepted matches ({} Match IDs accepted more than once).".format(
+        len(matching), len(accepted), accepted["Match ID"].duplicated().sum()))
+
+    if doc is not None:
+        matching.to_csv(doc)
+        if excel:
+            csv_to_excel(doc, os.path.splitext(doc)[0] + ".xlsx")
+    if do_file is not None:
+        with open(do_file, "w") as file:
+            for block in replace_lines(matching, condition=condition, threshold=threshold, exclude=exclude,
+                                       changed_only=changed_only):
+                file.write("\n" + block)
+    return matching
+
+
+def local(folder, processes=2, workers=1, **merge_options):
+    """ Starts "run --next" in several processes of this machine, as another machine would, and merges the shards
+    once they finish. """
+    command = [sys.executable, os.path.abspath(__file__), "run", folder, "--next", "--workers", str(workers)]
+    running = [subprocess.Popen(command) for _ in range(processes)]
+    for process in running:
+        process.wait()
+    return merge(folder, **merge_options)
+
+
+def write_json(path, content):
+    """ Writes a JSON file atomically (through a temporary file). """
+    with open(path + ".tmp", "w") as file:
+        json.dump(content, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs do_match in shards, on several machines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    planning = commands.add_parser("plan", help="Divide the original database in shards.")
+    planning.add_argument("original", help="Matcher CSV file with the schools to be matched.")
+    planning.add_argument("comparison", help="Matcher CSV file with the comparison schools.")
+    planning.add_argument("--folder", default="shards", help="Folder of the shards (shared by every machine).")
+    planning.add_argument("--shards", type=int, default=8, help="Number of shards.")
+    planning.add_argument("--av-meet", choices=["yes", "no"], default=None,
+                          help="Whether the files include the meeting time (by default, if they have a fifth column).")
+    planning.add_argument("--mode", choices=MODES, default="greedy", help="do_match or match_one_to_one.")
+    planning.add_argument("--options", default="{}", help="JSON with the keyword arguments of do_match "
+                                                          "(or match_one_to_one), e.g. '{\"accept_score\": 96}'.")
+
+    running = commands.add_parser("run", help="Match one shard, or every shard nobody has claimed.")
+    running.add_argument("folder")
+    which = running.add_mutually_exclusive_group(required=True)
+    which.add_argument("--shard", type=int, help="The shard (it's run, or resumed, even if it's claimed).")
+    which.add_argument("--next", action="store_true", help="Claim and run the shards nobody has started.")
+    running.add_argument("--workers", type=int, default=1, help="The workers option of do_match.")
+
+    showing = commands.add_parser("status", help="Show which shards are done.")
+    showing.add_argument("folder")
+
+    for name, help_text in [("merge", "Check every shard and assemble the results."),
+                            ("local", "Run the shards as processes of this machine, and merge them.")]:
+        merging = commands.add_parser(name, help=help_text)
+        merging.add_argument("folder")
+        merging.add_argument("--doc", default=None, help="CSV file with the match table.")
+        merging.add_argument("--excel", action="store_true", help="Also write the table as an Excel Spreadsheet.")
+        merging.add_argument("--do-file", default=None, help="Do-file with the replace lines.")
+        merging.add_argument("--threshold", type=float, default=95, help="Minimum similarity (exclusive).")
+        merging.add_argument("--exclude", type=int, nargs="*", default=[248814], help="Match IDs never accepted.")
+        merging.add_argument("--changed-only", action="store_true", help="Skip the matches with the same ID.")
+        merging.add_argument("--condition", default="", help="Text added to every replace line.")
+        if name == "local":
+            merging.add_argument("--processes", type=int, default=2, help="Number of processes.")
+            merging.add_argument("--workers", type=int, default=1, help="The workers option of do_match.")
+    arguments = parser.parse_args()
+
+    if arguments.command == "plan":
+        av_meet = None if arguments.av_meet is None else arguments.av_meet == "yes"
+        manifest = plan(arguments.original, arguments.comparison, arguments.folder, arguments.shards, av_meet,
+                        arguments.mode, json.loads(arguments.options))
+        for entry in manifest["shards"]:
+            print("Shard {}: {} schools, departments {}".format(entry["shard"], entry["schools"],
+                                                                entry["departments"]))
+    elif arguments.command == "run":
+        if arguments.next:
+            run_next(arguments.folder, arguments.workers)
+        else:
+            run(arguments.folder, arguments.shard, arguments.workers)
+    elif arguments.command == "status":
+        for shard, state in status(arguments.folder).items():
+            print("Shard {}: {}".format(shard, state))
+    else:
+        options = {"doc": arguments.doc, "do_file": arguments.do_file, "excel": arguments.excel,
+                   "threshold": arguments.threshold, "exclude": arguments.exclude,
+                   "changed_only": arguments.changed_only, "condition": arguments.condition}
+        if arguments.command == "merge":
+            merge(arguments.folder, **options)
+        else:
+            local(arguments.folder, arguments.processes, arguments.workers, **options)
+
+
+if __name__ == "__main__":
+    main()